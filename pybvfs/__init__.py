@@ -1 +1 @@
-from . import core, fsdump, fsfix
\ No newline at end of file
+from . import core, aio, bench, compact, fsck, fsdump, fsfix
\ No newline at end of file
@@ -0,0 +1,22 @@
+from . import bench, compact, fsck, fsdump
+import sys
+
+# Tools that can be run as python -m pybvfs <tool> [arguments]
+tools = {
+    "bench": bench.main,
+    "compact": compact.main,
+    "fsck": fsck.main,
+    "fsdump": fsdump.main,
+}
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in tools:
+        print(f"usage: python -m pybvfs {{{','.join(tools)}}} [arguments]", file=sys.stderr)
+        return 2
+    return tools[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+from . import core
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+
+
+class AsyncBVFSFile:
+    """
+    Awaitable wrapper of a BVFSFile, returned by AsyncBVFS.open. Calls on
+    the same file run one at a time, a BVFSFile is not meant to be used by
+    more than one thread at once.
+    """
+
+    def __init__(self, parent: "AsyncBVFS", file: core.BVFSFile) -> None:
+        self.parent = parent
+        self.file = file
+        self._lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await self.parent._run(func, *args)
+
+    async def read(self, numbytes: int = None) -> bytes:
+        return await self._run(self.file.read, numbytes)
+
+    async def readinto(self, buffer) -> int:
+        return await self._run(self.file.readinto, buffer)
+
+    async def write(self, data) -> int:
+        return await self._run(self.file.write, data)
+
+    async def truncate(self, size: int = None) -> int:
+        return await self._run(self.file.truncate, size)
+
+    async def seek(self, pos: int, whence: int = 0) -> int:
+        return await self._run(self.file.seek, pos, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    async def close(self) -> None:
+        await self._run(self.file.close)
+
+    async def __aenter__(self) -> "AsyncBVFSFile":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+class AsyncBVFS:
+    """
+    asyncio front end of an open BVFS. Every call runs the matching BVFS
+    method on a thread pool so the event loop never waits on disk I/O, at
+    most maxworkers of them run at a time. An executor can be passed in to
+    share one between filesystems, it is then not shut down on close.
+    Use openfs to open the filesystem itself without blocking.
+    Concurrent reads of a block missing from the cache share a single read,
+    whichever call they come from.
+    """
+
+    def __init__(self, fs: core.BVFS, executor: ThreadPoolExecutor = None, maxworkers: int = 4) -> None:
+        self.fs = fs
+        self._ownexecutor = executor is None
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=maxworkers, thread_name_prefix="bvfs")
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
+
+    async def readblock(self, blocknum: int) -> bytearray:
+        """
+        Reads a block through the block cache
+        """
+        return await self._run(self.fs._blockio.readblock, blocknum)
+
+    async def open(self, filename: str, mode: str, compression: str = None) -> AsyncBVFSFile:
+        return AsyncBVFSFile(self, await self._run(self.fs.open, filename, mode, compression))
+
+    async def exists(self, nodename: str) -> bool:
+        return await self._run(self.fs.exists, nodename)
+
+    async def lsdir(self, dirname: str) -> list:
+        return await self._run(self.fs.lsdir, dirname)
+
+    async def stat(self, path: str) -> core.NodeStat:
+        return await self._run(self.fs.stat, path)
+
+    async def scandir(self, dirname: str) -> list:
+        return await self._run(self.fs.scandir, dirname)
+
+    async def mkdir(self, dirname: str) -> None:
+        await self._run(self.fs.mkdir, dirname)
+
+    async def rmdir(self, dirname: str) -> None:
+        await self._run(self.fs.rmdir, dirname)
+
+    async def rmfile(self, filename: str) -> None:
+        await self._run(self.fs.rmfile, filename)
+
+    async def flush(self) -> None:
+        await self._run(self.fs.flush)
+
+    async def close(self) -> None:
+        """
+        Closes the filesystem, files still open should be closed first
+        """
+        await self._run(self.fs.close)
+        if self._ownexecutor:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncBVFS":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+async def openfs(filename: str, executor: ThreadPoolExecutor = None, maxworkers: int = 4, **kwargs) -> AsyncBVFS:
+    """
+    Opens the filesystem in filename on the thread pool and returns an
+    AsyncBVFS for it. Extra keyword arguments go to BVFS.
+    """
+    afs = AsyncBVFS(None, executor, maxworkers)
+    try:
+        afs.fs = await afs._run(core.BVFS, filename, **kwargs)
+    except BaseException:
+        if afs._ownexecutor:
+            afs._executor.shutdown(wait=False)
+        raise
+    return afs
@@ -0,0 +1,266 @@
+from . import core
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+MB = 1024*1024
+
+
+def _newfs(path: str, fskw: dict) -> core.BVFS:
+    core.createFs(path)
+    return core.BVFS(path, **fskw)
+
+
+def _rate(amount: float, seconds: float) -> float:
+    return round(amount/seconds, 3) if seconds > 0 else None
+
+
+def _readall(fs: core.BVFS, name: str, chunk: int = 64*1024) -> int:
+    total = 0
+    with fs.open(name, 'r') as fp:
+        while data := fp.read(chunk):
+            total += len(data)
+    return total
+
+
+def bench_seqio(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    Sequential writes and reads of whole files of a few sizes, about
+    32 MiB of each size at scale 1
+    """
+    results = {}
+    for size in (4*1024, 64*1024, MB, 16*MB):
+        count = max(1, min(2000, int(32*MB*scale)//size))
+        data = rng.randbytes(size)
+        fs = _newfs(path, fskw)
+        fs.mkdir("/seq")
+        start = time.perf_counter()
+        for x in range(count):
+            with fs.open(f"/seq/f{x}", 'w') as fp:
+                fp.write(data)
+        fs.flush()
+        write = time.perf_counter()-start
+        start = time.perf_counter()
+        for x in range(count):
+            _readall(fs, f"/seq/f{x}", MB)
+        read = time.perf_counter()-start
+        fs.close()
+        results[str(size)] = {"files": count, "writembps": _rate(count*size/MB, write),
+                              "readmbps": _rate(count*size/MB, read)}
+    return results
+
+
+def bench_randio(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    4 KiB reads and in place writes at random offsets of a 16 MiB file
+    """
+    size = max(MB, int(16*MB*scale))
+    ops = max(100, int(4000*scale))
+    fs = _newfs(path, fskw)
+    with fs.open("/rand", 'w') as fp:
+        fp.write(rng.randbytes(size))
+    offsets = [rng.randrange(size-4096) for _ in range(ops)]
+    block = rng.randbytes(4096)
+    fp = fs.open("/rand", 'r+')
+    start = time.perf_counter()
+    for offset in offsets:
+        fp.seek(offset)
+        fp.read(4096)
+    read = time.perf_counter()-start
+    start = time.perf_counter()
+    for offset in offsets:
+        fp.seek(offset)
+        fp.write(block)
+    fp.close()
+    fs.flush()
+    write = time.perf_counter()-start
+    fs.close()
+    return {"filesize": size, "ops": ops, "readops": _rate(ops, read), "writeops": _rate(ops, write)}
+
+
+def bench_dirops(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    mkdir, exists, lsdir and scandir on a directory of 5000 subdirectories
+    """
+    count = max(100, int(5000*scale))
+    names = [f"/big/d{x}" for x in range(count)]
+    rng.shuffle(names)
+    fs = _newfs(path, fskw)
+    fs.mkdir("/big")
+    start = time.perf_counter()
+    for name in names:
+        fs.mkdir(name)
+    mkdir = time.perf_counter()-start
+    start = time.perf_counter()
+    for name in names:
+        fs.exists(name)
+    hits = time.perf_counter()-start
+    start = time.perf_counter()
+    for name in names:
+        fs.exists(name+"x")
+    misses = time.perf_counter()-start
+    start = time.perf_counter()
+    fs.lsdir("/big")
+    lsdir = time.perf_counter()-start
+    start = time.perf_counter()
+    fs.scandir("/big")
+    scandir = time.perf_counter()-start
+    start = time.perf_counter()
+    fs.mkdir_many([f"/bulk{x}" for x in range(count)])
+    mkdirmany = time.perf_counter()-start
+    fs.close()
+    return {"entries": count, "mkdirops": _rate(count, mkdir), "existsops": _rate(count, hits),
+            "missingops": _rate(count, misses), "lsdirseconds": round(lsdir, 6),
+            "scandirseconds": round(scandir, 6), "mkdirmanyops": _rate(count, mkdirmany)}
+
+
+def bench_realloc(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    Creating 8 KiB files on an empty image and again after half the files
+    were deleted, which leaves the free space in small pieces
+    """
+    count = max(100, int(4000*scale))
+    data = rng.randbytes(8*1024)
+    fs = _newfs(path, fskw)
+    fs.mkdir("/r")
+    start = time.perf_counter()
+    for x in range(count):
+        with fs.open(f"/r/f{x}", 'w') as fp:
+            fp.write(data)
+    fresh = time.perf_counter()-start
+    before = fs._blockio.blocklen
+    start = time.perf_counter()
+    for x in range(0, count, 2):
+        fs.rmfile(f"/r/f{x}")
+    delete = time.perf_counter()-start
+    start = time.perf_counter()
+    for x in range(0, count, 2):
+        with fs.open(f"/r/n{x}", 'w') as fp:
+            fp.write(data)
+    reuse = time.perf_counter()-start
+    grown = fs._blockio.blocklen-before
+    fs.close()
+    return {"files": count, "freshops": _rate(count, fresh), "deleteops": _rate(-(-count//2), delete),
+            "reuseops": _rate(-(-count//2), reuse), "grownblocks": grown}
+
+
+def bench_cache(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    Reading a file and listing a directory right after opening the image,
+    with empty caches, and again with the caches filled
+    """
+    size = max(MB, int(8*MB*scale))
+    count = max(100, int(2000*scale))
+    fs = _newfs(path, fskw)
+    with fs.open("/file", 'w') as fp:
+        fp.write(rng.randbytes(size))
+    fs.mkdir("/dir")
+    fs.create_many({f"/dir/f{x}": b"" for x in range(count)})
+    fs.close()
+    fs = core.BVFS(path, **fskw)
+    results = {"filesize": size, "entries": count}
+    for run in ("cold", "warm"):
+        start = time.perf_counter()
+        _readall(fs, "/file")
+        results[run+"readmbps"] = _rate(size/MB, time.perf_counter()-start)
+        start = time.perf_counter()
+        fs.scandir("/dir")
+        results[run+"scandirseconds"] = round(time.perf_counter()-start, 6)
+    results["cache"] = fs.cachestats()
+    fs.close()
+    return results
+
+
+def bench_threads(path: str, rng: random.Random, scale: float, fskw: dict) -> dict:
+    """
+    Total read throughput of 1 to 8 threads each reading their own files
+    """
+    size = max(MB//4, int(4*MB*scale))
+    fs = _newfs(path, fskw)
+    for x in range(8):
+        with fs.open(f"/t{x}", 'w') as fp:
+            fp.write(rng.randbytes(size))
+    results = {"filesize": size}
+    for threads in (1, 2, 4, 8):
+        with ThreadPoolExecutor(threads) as pool:
+            start = time.perf_counter()
+            list(pool.map(lambda x: _readall(fs, f"/t{x}"), range(8)))
+            results[f"{threads}mbps"] = _rate(8*size/MB, time.perf_counter()-start)
+    fs.close()
+    return results
+
+
+# Benchmarks by the name results are stored under
+BENCHMARKS = {
+    "seqio": bench_seqio,
+    "randio": bench_randio,
+    "dirops": bench_dirops,
+    "realloc": bench_realloc,
+    "cache": bench_cache,
+    "threads": bench_threads,
+}
+
+
+def run(names=None, scale: float = 1.0, seed: int = 0, workdir: str = None, progress=None, **fskw) -> dict:
+    """
+    Runs the benchmarks in names, all of them by default, each on a new
+    image in workdir or a temporary directory. scale multiplies the amount
+    of data and operations, the data comes from a random generator seeded
+    with seed so runs are comparable. Extra keyword arguments go to BVFS.
+    progress is called with the name of every benchmark before it starts.
+    Returns the results along with what they were measured on.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        path = os.path.join(tmp, "bench.bvfs")
+        for name in names or BENCHMARKS:
+            if progress is not None:
+                progress(name)
+            start = time.perf_counter()
+            results[name] = BENCHMARKS[name](path, random.Random(seed), scale, fskw)
+            results[name]["seconds"] = round(time.perf_counter()-start, 3)
+            for leftover in (path, path+"-journal"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    return {"fsversion": core.FS_VERSION, "python": platform.python_version(),
+            "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scale": scale, "seed": seed, "options": fskw, "results": results}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m pybvfs bench",
+        description="Runs BVFS benchmarks on synthetic data and prints the results as JSON.")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS),
+                        help="run only this benchmark, can be given more than once")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplies the amount of data and operations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=None, help="directory the images are made in")
+    parser.add_argument("--output", default=None, help="file the results are written to")
+    parser.add_argument("--writeback", action="store_true")
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--journal", action="store_true")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    fskw = {key: True for key in ("writeback", "mmap", "journal") if getattr(args, key)}
+
+    def progress(name):
+        if not args.quiet:
+            print(name, file=sys.stderr, flush=True)
+
+    results = run(args.only, args.scale, args.seed, args.dir, progress, **fskw)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    return 0
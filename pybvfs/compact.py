@@ -0,0 +1,43 @@
+from . import core
+import argparse
+import sys
+
+
+def compact(filename: str, progress=None, maxmoves: int = None, **kwargs) -> bool:
+    """
+    Opens the filesystem in filename and compacts it, see BVFS.compact.
+    Extra keyword arguments go to BVFS. journal=True speeds up big images
+    and keeps every move safe from crashes, writeback alone does not as the
+    moves could reach the file out of order.
+    Returns True when the image is fully compacted, False when it stopped
+    after maxmoves moves. Running it again resumes the work.
+    """
+    fs = core.BVFS(filename, **kwargs)
+    try:
+        return fs.compact(progress=progress, maxmoves=maxmoves)
+    finally:
+        fs.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m pybvfs compact",
+        description="Moves all live blocks of a BVFS image to the front and shrinks it.")
+    parser.add_argument("image")
+    parser.add_argument("--max-moves", type=int, default=None,
+                        help="stop after this many block moves, run again to resume")
+    parser.add_argument("--journal", action="store_true",
+                        help="faster on big images, moves are made durable in batches through a journal")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        if not args.quiet:
+            print(f"\r{done}/{total} blocks", end='', file=sys.stderr, flush=True)
+
+    done = compact(args.image, progress=progress,
+                   maxmoves=args.max_moves, journal=args.journal)
+    if not args.quiet:
+        print(file=sys.stderr)
+        print("Compacted" if done else "Stopped early, run again to resume")
+    return 0 if done else 1
@@ -1,10 +1,43 @@
 
-from functools import partial
-from threading import Lock
+import io
+import os
+import shutil
+import struct
+import zlib
+from bisect import bisect_right
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from mmap import mmap as _mmap
+from threading import Condition, Lock, RLock, get_ident, local
+from time import perf_counter
+from weakref import WeakSet
+try:
+    import lzma
+except ImportError:  # Python builds without liblzma
+    lzma = None
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 
 # Constants
 FS_VERSION = 1
 BLOCK_SIZE = 1024
+MMAP_CHUNK = 4*1024*1024  # The memory map grows in steps of this many bytes
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+READ_RUN = 256  # Most contiguous blocks fetched by a single read
+COPY_CHUNK = 1024*1024  # Bytes copied at a time by export_tree and import_tree
+IMPORT_BATCH = 4*1024*1024  # import_tree creates smaller files in batches of about this size
+FRAME_SIZE = 64*1024  # Bytes compressed together in a compressed file
+COMPRESSIONS = {"zlib": 1, "lzma": 2}  # Compression names to their NodeMetadata ids
+INLINE_MAX = BLOCK_SIZE-52  # Files up to this size are kept in their NodeMetadata block
+JOURNAL_LOCK = 2  # Root lock flag of a filesystem opened with a journal
+JOURNAL_LIMIT = 64*1024*1024  # The journal is checkpointed once it grows past this many bytes
 
 # Error classes definition
 
@@ -86,8 +119,73 @@ def _block(d: bytes, btype: int):
     return data
 
 
+def _entryname(entry: bytes) -> str:
+    """
+    Decodes the null terminated node name of a 124 byte directory entry
+    """
+    return bytes(entry[16:16+100]).split(b'\0', 1)[0].decode('utf-8')
+
+
 _intfb = partial(int.from_bytes, byteorder='big', signed=False)
 _inttb = partial(int.to_bytes, byteorder='big', signed=False)
+_FULLDATAHEADER = _block(_inttb(998, 2), 1)  # Header of a completely filled data block
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _syncdir(path: str) -> None:
+    """
+    Syncs the directory holding path so a file created there survives a
+    power loss. Platforms that can not open directories are skipped.
+    """
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# A directory entry as indexed in memory, block and slot locate it on disk
+_DirEntry = namedtuple("_DirEntry", ["nm", "ptr", "block", "slot"])
+
+# What BVFS.stat and BVFS.scandir return for a node, type is 1 for files
+# and 2 for directories like in the NodeMetadata block
+NodeStat = namedtuple("NodeStat", ["name", "type", "size", "perms", "uid", "gid"])
+
+
+class _Directory:
+    """
+    In memory view of a directory built by one walk over its blocks. Besides
+    the entries by name it knows the block chain, how many slots of every
+    block are used and which slots are free, so inserts never rescan.
+    """
+
+    def __init__(self) -> None:
+        self.entries = {}
+        self.chain = []  # Directory blocks in chain order
+        self.used = {}  # Block number to the count of used slots
+        self.free = []  # Free (block, slot) pairs, the next one to use is last
+
+    def takeslot(self):
+        # Slots of blocks unlinked since they were freed are skipped
+        while self.free:
+            if (slot := self.free.pop())[0] in self.used:
+                return slot
+        return None
+
+
+class _OpenNode:
+    """
+    The files open on a node. A node removed while some are open is only
+    unlinked from its directory, its blocks are released once the last of
+    them is closed and ptr follows its first superblock meanwhile.
+    """
+
+    def __init__(self) -> None:
+        self.files = WeakSet()  # Files dropped without being closed leave on their own
+        self.removed = False
+        self.ptr = 0
 
 # Internal Blocks Methods
 
@@ -111,10 +209,15 @@ class _Blocks:
             _fitb(name.encode('utf-8'), 99)+b'\0'
         return _fitb(data, 124)
 
+    # Content given as inline is stored in the block itself
     @staticmethod
-    def createNodeMetadataBlock(perms: int, groupid: int, userid: int, size: int, ntype: int):
+    def createNodeMetadataBlock(perms: int, groupid: int, userid: int, size: int, ntype: int,
+                                compression: int = 0, framesize: int = 0, inline: bytes = None):
         data = _inttb(perms, 2) + _inttb(groupid, 4) + \
-            _inttb(userid, 4) + _inttb(size, 8) + _inttb(ntype, 1)
+            _inttb(userid, 4) + _inttb(size, 8) + _inttb(ntype, 1) + \
+            _inttb(compression, 1) + _inttb(framesize, 4)
+        if inline is not None:
+            data += _inttb(1, 1) + _inttb(len(inline), 2) + b'\0' + inline
         return _fitb(_block(data, 3))
 
     @staticmethod
@@ -138,6 +241,581 @@ def createFs(filename):
         bfp.writeblock(0, _Blocks.createRootBlock())
         bfp.writeblock(1, _Blocks.createDirectoryBlock())
 
+class _BlockCache:
+    """
+    A segmented LRU cache of blocks keyed by their block number. Newly read
+    blocks enter a probationary segment and are only promoted to the
+    protected segment when they are hit again, so a long sequential read can
+    not push out frequently used blocks like the root directory. All the
+    operations are constant time. The capacity is given in blocks and/or in
+    bytes, whichever is smaller is used.
+
+    A lookup never changes the segments, hits are logged and applied on the
+    next insert. So get is safe to call without holding any lock while
+    put, update and clear are serialized by the owner. Under concurrent use
+    the counters are approximate.
+    """
+
+    def __init__(self, maxblocks: int, maxbytes: int = None, block_size: int = BLOCK_SIZE) -> None:
+        self.capacity = max(maxblocks, 0)
+        if maxbytes is not None:
+            self.capacity = min(self.capacity, maxbytes//block_size)
+        self.protectedcap = self.capacity*4//5
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.hitlog = deque(maxlen=max(self.capacity, 1))  # Hits not applied yet, oldest dropped first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, blocknum: int):
+        if (data := self.protected.get(blocknum)) is None:
+            data = self.probation.get(blocknum)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.hitlog.append(blocknum)
+        return data
+
+    def _applyhits(self) -> None:
+        while self.hitlog:
+            blocknum = self.hitlog.popleft()
+            if blocknum in self.protected:
+                self.protected.move_to_end(blocknum)
+            elif (data := self.probation.pop(blocknum, None)) is not None:
+                self.protected[blocknum] = data
+                if len(self.protected) > self.protectedcap:
+                    # Demote the least recently used protected block instead of dropping it
+                    demoted, ddata = self.protected.popitem(last=False)
+                    self.probation[demoted] = ddata
+
+    def put(self, blocknum: int, data: bytearray) -> None:
+        if self.capacity == 0:
+            return
+        self._applyhits()
+        if blocknum in self.protected:
+            # Missed by a lookup racing a promotion
+            self.protected[blocknum] = data
+            return
+        self.probation[blocknum] = data
+        while len(self.probation)+len(self.protected) > self.capacity:
+            if self.probation:
+                self.probation.popitem(last=False)
+            else:
+                self.protected.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, blocknum: int) -> bool:
+        return blocknum in self.protected or blocknum in self.probation
+
+    def update(self, blocknum: int, data: bytearray) -> None:
+        # Replaces the data of a cached block without changing its recency
+        if blocknum in self.protected:
+            self.protected[blocknum] = data
+        elif blocknum in self.probation:
+            self.probation[blocknum] = data
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitratio": self.hits/lookups if lookups else 0.0,
+            "blocks": len(self.probation)+len(self.protected),
+            "capacity": self.capacity
+        }
+
+    def clear(self) -> None:
+        self.probation.clear()
+        self.protected.clear()
+        self.hitlog.clear()
+
+    def __len__(self) -> int:
+        return len(self.probation)+len(self.protected)
+
+class _FreeSpace:
+    """
+    Index of the free blocks of a filesystem kept as sorted, non touching
+    free extents [start, end). Every block from end onwards is free too, so
+    trailing free blocks never show up as an extent. Handing out the first
+    free block and releasing a block never read the blocks themselves.
+    """
+
+    def __init__(self, blocktypes: bytes = b'', end: int = 0) -> None:
+        self.starts = []
+        self.ends = []
+        self.end = end
+        self.scanned = 0
+        if blocktypes:
+            self._build(blocktypes)
+
+    def _build(self, blocktypes: bytes) -> None:
+        # Walk the used blocks, every gap between two of them is an extent
+        blocktypes = bytes(blocktypes).rstrip(b'\0')
+        self.end = len(blocktypes)
+        x = blocktypes.find(0)
+        while x != -1:
+            y = x
+            while blocktypes[y] == 0:
+                y += 1
+            self.starts.append(x)
+            self.ends.append(y)
+            x = blocktypes.find(0, y)
+
+    def allocate(self) -> int:
+        if not self.starts:
+            self.end += 1
+            return self.end - 1
+        blocknum = self.starts[0]
+        self.starts[0] += 1
+        if self.starts[0] == self.ends[0]:
+            del self.starts[0], self.ends[0]
+        return blocknum
+
+    def allocaterun(self, count: int) -> int:
+        """
+        Reserves count contiguous blocks and returns the first one. The first
+        free extent big enough is used, otherwise the run goes at the end.
+        The number of extents looked at is left in scanned.
+        """
+        for x in range(len(self.starts)):
+            if self.ends[x]-self.starts[x] >= count:
+                self.scanned = x+1
+                blocknum = self.starts[x]
+                self.starts[x] += count
+                if self.starts[x] == self.ends[x]:
+                    del self.starts[x], self.ends[x]
+                return blocknum
+        self.scanned = len(self.starts)
+        self.end += count
+        return self.end - count
+
+    def release(self, blocknum: int) -> None:
+        if blocknum >= self.end:
+            return
+        if blocknum == self.end - 1:
+            self.end -= 1
+            if self.ends and self.ends[-1] == self.end:
+                self.end = self.starts.pop()
+                self.ends.pop()
+            return
+        x = bisect_right(self.starts, blocknum)
+        if x > 0 and self.ends[x-1] > blocknum:
+            return  # Already free
+        joinprev = x > 0 and self.ends[x-1] == blocknum
+        joinnext = x < len(self.starts) and self.starts[x] == blocknum+1
+        if joinprev and joinnext:
+            self.ends[x-1] = self.ends[x]
+            del self.starts[x], self.ends[x]
+        elif joinprev:
+            self.ends[x-1] += 1
+        elif joinnext:
+            self.starts[x] -= 1
+        else:
+            self.starts.insert(x, blocknum)
+            self.ends.insert(x, blocknum+1)
+
+    def todata(self, size: int) -> bytes:
+        """
+        Serializes the index to at most size bytes, None if it does not fit
+        """
+        if 10+16*len(self.starts) > size:
+            return None
+        data = _inttb(self.end, 8)+_inttb(len(self.starts), 2)
+        for start, end in zip(self.starts, self.ends):
+            data += _inttb(start, 8)+_inttb(end, 8)
+        return data
+
+    @classmethod
+    def fromdata(cls, data: bytes) -> "_FreeSpace":
+        fs = cls(end=_intfb(data[0:8]))
+        for x in range(_intfb(data[8:10])):
+            fs.starts.append(_intfb(data[10+x*16:10+x*16+8]))
+            fs.ends.append(_intfb(data[10+x*16+8:10+x*16+16]))
+        return fs
+
+
+def _writeruns(bio: "BlockIO", blocks: dict) -> None:
+    """
+    Writes a dict of full sized blocks by block number, blocks next to each
+    other are written with a single call.
+    """
+    blocknums = sorted(blocks)
+    start = 0
+    for x in range(1, len(blocknums)+1):
+        if x == len(blocknums) or blocknums[x] != blocknums[x-1]+1:
+            bio.writerun(blocknums[start], [blocks[y]
+                         for y in blocknums[start:x]])
+            start = x
+
+
+def _pwriteall(fd: int, buffers: list, offset: int, file=None) -> None:
+    """
+    Writes the buffers one after another starting at offset, using a single
+    positional vectored write for every IOV_MAX of them where the platform
+    has one. Otherwise, or without a fd, the buffers are joined and written
+    through file.
+    """
+    if fd is None or not hasattr(os, "pwritev"):
+        file.seek(offset)
+        file.write(b''.join(buffers))
+        file.flush()
+        return
+    for x in range(0, len(buffers), IOV_MAX):
+        chunk = buffers[x:x+IOV_MAX]
+        total = sum(len(b) for b in chunk)
+        written = os.pwritev(fd, chunk, offset)
+        if written != total:  # Short write, finish the rest plainly
+            rest = b''.join(chunk)[written:]
+            while rest:
+                n = os.pwrite(fd, rest, offset+written)
+                rest = rest[n:]
+                written += n
+        offset += total
+
+class _DentryCache:
+    """
+    A bounded LRU cache of resolved directory paths. A path maps either to
+    the first block of its directory or to the reason it could not be
+    opened, negative entries are grouped by the path component that failed
+    so creating or removing a node there drops exactly the entries it
+    affects. It is thread safe, a path resolved while anything was
+    invalidated is not stored as it may already be stale.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries = OrderedDict()  # path -> block number or (failed prefix, message)
+        self.negatives = {}  # failed prefix -> paths that failed there
+        self.generation = 0  # Bumped by every invalidation
+        self.lock = Lock()
+
+    def get(self, path: str):
+        with self.lock:
+            if (value := self.entries.get(path)) is not None:
+                self.entries.move_to_end(path)
+            return value
+
+    def _unlist(self, path: str, value) -> None:
+        # Removes a negative entry from its prefix set, the set goes once empty
+        if isinstance(value, tuple) and (paths := self.negatives.get(value[0])) is not None:
+            paths.discard(path)
+            if not paths:
+                del self.negatives[value[0]]
+
+    def _put(self, path: str, value, generation: int) -> bool:
+        # Must be called with the lock held
+        if self.capacity <= 0 or generation != self.generation:
+            return False
+        self._unlist(path, self.entries.get(path))
+        self.entries[path] = value
+        if len(self.entries) > self.capacity:
+            self._unlist(*self.entries.popitem(last=False))
+        return True
+
+    def putdir(self, path: str, dirnode: int, generation: int) -> None:
+        with self.lock:
+            self._put(path, dirnode, generation)
+
+    def putmissing(self, path: str, prefix: str, message: str, generation: int) -> None:
+        with self.lock:
+            if self._put(path, (prefix, message), generation):
+                self.negatives.setdefault(prefix, set()).add(path)
+
+    def invalidate(self, path: str) -> None:
+        """
+        Drops what is known about path, call it whenever a node is created
+        or removed at path
+        """
+        with self.lock:
+            self.generation += 1
+            self._unlist(path, self.entries.pop(path, None))
+            for negpath in self.negatives.pop(path, ()):
+                self.entries.pop(negpath, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.negatives.clear()
+
+
+class _RWLock:
+    """
+    A reader-writer lock, any number of readers or a single writer hold it
+    at a time. Waiting writers keep new readers out so they can not be
+    starved. The writer may take it again, for reading or writing, while it
+    holds it. A lock of a removed directory is marked as removed.
+    """
+
+    def __init__(self) -> None:
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = None  # Thread holding the lock for writing
+        self.depth = 0  # How many times the writer holds it
+        self.waiting = 0  # Writers waiting for it
+        self.removed = False
+
+    def acquire(self, write: bool) -> None:
+        me = get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+            elif write:
+                self.waiting += 1
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+                self.waiting -= 1
+                self.writer = me
+                self.depth = 1
+            else:
+                while self.writer is not None or self.waiting:
+                    self.cond.wait()
+                self.readers += 1
+
+    def release(self) -> None:
+        with self.cond:
+            if self.writer == get_ident():
+                self.depth -= 1
+                if self.depth == 0:
+                    self.writer = None
+                    self.cond.notify_all()
+            else:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+
+def _normpath(path: str) -> str:
+    """
+    Returns a path the way the directory cache stores it, the first
+    component is skipped like the path resolution does.
+    """
+    return "/" + "/".join(x for x in path.split("/")[1:] if x)
+
+
+def _hostname(bdir: str, name: str) -> str:
+    """
+    Returns an entry name of the directory bdir for use on the host. Names
+    come from the image, one that is not a plain file name there could put
+    an export outside its destination.
+    """
+    if (name in ("", ".", "..") or "/" in name or "\0" in name or os.sep in name
+            or (os.altsep and os.altsep in name) or os.path.splitdrive(name)[0]):
+        raise BVFSError(f"Can not export {name!r} in {bdir}, it is not a valid host file name")
+    return name
+
+
+class _Journal:
+    """
+    A write-ahead redo journal kept in a file next to the image. A commit
+    appends one record holding every block written since the previous one
+    and syncs it before the blocks go to the image. A checkpoint syncs the
+    image and empties the journal. Replaying writes the blocks of every
+    complete record in order, a torn record at the end is ignored.
+
+    A record is the magic b"BvJr", a 64-bit sequence number, a 32-bit block
+    count, the 64-bit length of the image in blocks, the 64-bit number of
+    every block, the blocks themselves and the CRC-32 of all but the magic.
+    """
+    MAGIC = b"BvJr"
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE) -> None:
+        self.path = path
+        self.bs = block_size
+        created = not os.path.exists(path)
+        self.file = open(path, 'a+b', buffering=0)
+        if created:
+            # The journal must still be there after a power loss once the
+            # lock flag telling to replay it reaches the image
+            _syncdir(path)
+        self.size = self.file.seek(0, 2)
+        self.seq = 0
+
+    def lock(self) -> bool:
+        """
+        Locks the journal for this process until it is closed, returns False
+        when another process holds it
+        """
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def records(self):
+        """
+        Yields the image length and the (block number, block) pairs of every
+        complete record
+        """
+        self.file.seek(0)
+        data = memoryview(self.file.read())
+        offset = 0
+        seq = None
+        # A record header is the magic, sequence number, block count and image length, 24 bytes
+        while data[offset:offset+4] == self.MAGIC and offset+24 <= len(data):
+            rseq, count, blocklen = struct.unpack_from(">QIQ", data, offset+4)
+            end = offset+24+count*(8+self.bs)+4
+            if end > len(data) or (seq is not None and rseq != seq+1):
+                break
+            if zlib.crc32(data[offset+4:end-4]) != _intfb(data[end-4:end]):
+                break
+            base = offset+24+count*8
+            nums = struct.unpack_from(f">{count}Q", data, offset+24)
+            yield blocklen, [(blocknum, data[base+x*self.bs:base+(x+1)*self.bs])
+                             for x, blocknum in enumerate(nums)]
+            seq = self.seq = rseq
+            offset = end
+
+    def replay(self, file) -> int:
+        """
+        Writes every committed block to the image file, syncs it and empties
+        the journal. Returns the number of records replayed.
+        """
+        count = 0
+        for blocklen, blocks in self.records():
+            for blocknum, data in blocks:
+                file.seek(blocknum*self.bs)
+                file.write(data)
+            if file.seek(0, 2) < blocklen*self.bs:
+                file.truncate(blocklen*self.bs)
+            count += 1
+        file.flush()
+        os.fsync(file.fileno())
+        self.reset()
+        return count
+
+    def append(self, blocks: list, blocklen: int) -> None:
+        """
+        Appends a record of (block number, block) pairs and syncs the journal
+        """
+        self.seq += 1
+        body = [struct.pack(">QIQ", self.seq, len(blocks), blocklen),
+                struct.pack(f">{len(blocks)}Q", *(blocknum for blocknum, _ in blocks))]
+        body += [data for _, data in blocks]
+        crc = 0
+        for part in body:
+            crc = zlib.crc32(part, crc)
+        record = b''.join([self.MAGIC, *body, _inttb(crc, 4)])
+        self.file.seek(self.size)
+        self.file.write(record)
+        _datasync(self.file.fileno())
+        self.size += len(record)
+
+    def reset(self) -> None:
+        self.file.truncate(0)
+        _datasync(self.file.fileno())
+        self.size = 0
+
+    def close(self, remove: bool = False) -> None:
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+_BLOCKTYPES = ("unknown", "data", "superblock", "nodemetadata", "directory", "root")
+
+
+class Metrics:
+    """
+    Counters and histograms collected by a BVFS opened with metrics. The
+    histograms have power of two buckets, latencies are in microseconds
+    and sizes in bytes. When trace is given it is called with the name,
+    the duration in seconds and the exception raised, or None, of every
+    timed call. Only the outermost timed call of a thread is recorded, the
+    ones it makes internally, like open checking that a path exists, are
+    part of its latency. It is thread safe.
+    """
+
+    def __init__(self, trace=None) -> None:
+        self.trace = trace
+        self.counters = Counter()
+        self.histograms = {}  # Name to [count, total, max, bucket counts]
+        self.lock = Lock()
+        self._local = local()  # Whether each thread is in a timed call
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name: str, value: int) -> None:
+        with self.lock:
+            if (hist := self.histograms.get(name)) is None:
+                hist = self.histograms[name] = [0, 0, 0, [0]*65]
+            hist[0] += 1
+            hist[1] += value
+            hist[2] = max(hist[2], value)
+            hist[3][min(value.bit_length(), 64)] += 1
+
+    def timed(self, name: str, func, size=None):
+        """
+        Wraps func so the latency of every call goes to the histogram name,
+        size turns a result into the bytes moved for name + ".bytes".
+        """
+        @wraps(func)
+        def timedfunc(*args, **kwargs):
+            if getattr(self._local, "timing", False):
+                return func(*args, **kwargs)
+            self._local.timing = True
+            error = None
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                if size is not None:
+                    self.observe(name + ".bytes", size(result))
+                return result
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                seconds = perf_counter()-start
+                self._local.timing = False
+                self.observe(name, int(seconds*1000000))
+                if self.trace is not None:
+                    self.trace(name, seconds, error)
+        return timedfunc
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters and, for every histogram, its count, total,
+        maximum, approximate median and 99th percentile and the upper bound
+        and count of its non empty buckets
+        """
+        with self.lock:
+            hists = {}
+            for name, (count, total, top, buckets) in self.histograms.items():
+                hist = {"count": count, "total": total, "max": top}
+                for key, quantile in (("p50", 0.5), ("p99", 0.99)):
+                    seen = 0
+                    for bucket, n in enumerate(buckets):
+                        seen += n
+                        if seen >= quantile*count:
+                            hist[key] = min((1 << bucket)-1, top)
+                            break
+                hist["buckets"] = [[(1 << bucket)-1, n] for bucket, n in enumerate(buckets) if n]
+                hists[name] = hist
+            return {"counters": dict(self.counters), "histograms": hists}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def _typename(btype: int) -> str:
+    return _BLOCKTYPES[btype] if btype < len(_BLOCKTYPES) else "unknown"
+
+
+def _instrumentfile(fp, metrics: Metrics, prefix: str) -> None:
+    # Times the operations of a file object and records the bytes each moved
+    fp.read = metrics.timed(prefix+".read", fp.read, len)
+    fp.readinto = metrics.timed(prefix+".readinto", fp.readinto, int)
+    fp.write = metrics.timed(prefix+".write", fp.write, int)
+    fp.truncate = metrics.timed(prefix+".truncate", fp.truncate)
+
 # A file wrapper to prevent common errors from happening.
 # This helps dividing the file into blocks which can be read
 # from and written to. This should not be used for any other
@@ -149,9 +827,33 @@ class BlockIO:
     Block IO provides a way to read and write to files in terms of blocks.
     Note: This is not meant to be used and is there for internal purposes only.
     This class is liable to have breaking unannounced changes. It is thread safe.
+
+    Reads take no lock: cache hits only look the block up and misses use
+    positional reads, so there is no shared file position. Concurrent misses
+    on the same block share a single read. Writes are serialized by a single
+    lock. A block read while it is being written is not cached, so the cache
+    never keeps stale data. Files without a file descriptor, or platforms
+    without os.pread, fall back to seeking under the lock.
+
+    When mmap is set the file is memory mapped and blocks are returned as
+    writable memoryview slices of the mapping instead of cached copies, any
+    change to such a view goes straight to the file.
+
+    When writeback is set written blocks are kept in memory as dirty blocks,
+    repeated writes to a block only replace it in memory. They reach the file
+    on flush, or once there are more than dirtylimit of them, sorted by
+    block number with contiguous runs written in a single call. It has no
+    effect in mmap mode.
+
+    With a journal, writeback is always on and mmap off. Dirty blocks reach
+    the file only through commit, which puts them in the journal first, and
+    only between transactions so every transaction is committed whole.
     """
 
-    def __init__(self, file, block_size: int = BLOCK_SIZE, cachesize: int = 100) -> None:
+    def __init__(self, file, block_size: int = BLOCK_SIZE, cachesize: int = 100, cachebytes: int = None, mmap: bool = False,
+                 writeback: bool = False, dirtylimit: int = 4096, journal: _Journal = None) -> None:
+        if journal is not None:
+            mmap, writeback = False, True
         self.file = file
         self.bs = block_size
         self.file.seek(0, 2)
@@ -160,254 +862,1074 @@ class BlockIO:
             self.file.truncate(fsize-extra)
         self.blocklen = fsize//block_size
         self.file.seek(0)
-        self.previousblocknum = 0
-        self.cache = {}
-        self.cacheblocks = []
-        self.cachesize = cachesize
+        self.fd = None
+        if hasattr(os, "pread"):
+            try:
+                self.fd = self.file.fileno()
+            except (OSError, io.UnsupportedOperation):
+                pass
+        self.cache = _BlockCache(cachesize, cachebytes, block_size)
         self.lock = Lock()
+        self.writes = 0  # Bumped by every write, see readblock
+        self.inflight = {}  # Block number to the writes seen and future of the read in flight
+        self.inflightlock = Lock()
+        self.writeback = writeback and not mmap
+        self.dirtylimit = dirtylimit
+        self.dirty = {}
+        self.journal = journal
+        self.gate = _RWLock()  # Shared by transactions, taken exclusively to commit
+        self.local = local()  # Transaction depth of the thread
+        self.commitlock = RLock()  # Held throughout exclusive, whose holder still commits
+        self.committed = 0  # Value of writes covered by the last commit
+        self.mmap = mmap
+        self.map = None
+        self.view = memoryview(b'')
+        if mmap and self.blocklen != 0:
+            self._remap(self.blocklen*self.bs)
+
+    def _remap(self, size: int) -> None:
+        # A fresh mapping is made instead of resizing the old one, resizing is
+        # not possible while views handed out by readblock are still alive.
+        # Old views stay valid as they keep their own mapping of the file.
+        if size > self.blocklen*self.bs:
+            self.file.truncate(size)
+        self.map = _mmap(self.file.fileno(), size)
+        self.view = memoryview(self.map)
 
     def readblock(self, blocknum: int) -> bytearray:
-        if blocknum in self.cache:
-            return self.cache[blocknum]
-
-        self.lock.acquire()
-
-        if self.previousblocknum+1 != blocknum:
-            self.file.seek(self.bs*blocknum)
-            self.previousblocknum = blocknum
-        else:
-            self.previousblocknum += 1
-        data = bytearray(self.file.read(self.bs))
-
-        self.cache[blocknum] = data
-        self.cacheblocks.append(blocknum)
-        if len(self.cacheblocks) > self.cachesize:
-            del self.cache[self.cacheblocks.pop(0)]
-
-        self.lock.release()
+        if self.mmap:
+            return self.view[blocknum*self.bs:(blocknum+1)*self.bs]
+
+        # A write finishing between here and the cache insert might have
+        # been missed by the read, the block is only cached if there was none
+        writes = self.writes
+        if (data := self.dirty.get(blocknum)) is not None:
+            return data
+        if (data := self.cache.get(blocknum)) is not None:
+            return data
+
+        # A read in flight is only shared if no write happened since it began
+        with self.inflightlock:
+            if (read := self.inflight.get(blocknum)) is not None and read[0] == writes:
+                fut = read[1]
+            else:
+                read = self.inflight[blocknum] = (writes, Future())
+                fut = None
+        if fut is not None:
+            return fut.result()
+        try:
+            # Blocks past the end of the file that have not been flushed yet
+            # come back short and are padded
+            data = _fitb(self._readat(self.bs*blocknum, self.bs), self.bs)
+            with self.lock:
+                if self.writes == writes:
+                    self.cache.put(blocknum, data)
+        except BaseException as e:
+            read[1].set_exception(e)
+            raise
+        finally:
+            with self.inflightlock:
+                if self.inflight.get(blocknum) is read:
+                    del self.inflight[blocknum]
+        read[1].set_result(data)
         return data
 
     def writeblock(self, blocknum: int, data: bytes = b'', write: bool = True) -> None:
-        if blocknum == 5 and write:
-            if data[0] == 0:
-                breakpoint()
         if not isinstance(blocknum, int):
             raise TypeError("Block number must be an integer")
-        self.lock.acquire()
-        if self.previousblocknum+1 != blocknum:
-            self.file.seek(self.bs*blocknum)
-            self.previousblocknum = blocknum
+        if self.mmap:
+            self._writemapped(blocknum, data, write)
+            return
+        if self.writeback:
+            self._writeback(blocknum, data, write)
+            return
+        with self.lock:
+            if write:
+                pdata = _fitb(data, self.bs)
+                _pwriteall(self.fd, [pdata], blocknum*self.bs, self.file)
+                self.cache.update(blocknum, pdata)
+            elif blocknum >= self.blocklen:
+                self.file.truncate((blocknum+1)*self.bs)
+            self.blocklen = max(self.blocklen, blocknum+1)
+            self.writes += 1
+
+    def _writemapped(self, blocknum: int, data: bytes, write: bool) -> None:
+        with self.lock:
+            offset = blocknum*self.bs
+            if offset+self.bs > len(self.view):
+                self._remap((offset+self.bs+MMAP_CHUNK-1)//MMAP_CHUNK*MMAP_CHUNK)
+            if blocknum >= self.blocklen:
+                self.blocklen = blocknum + 1
+            if write:
+                if len(data) != self.bs:
+                    data = _fitb(bytes(data), self.bs)
+                self.view[offset:offset+self.bs] = data
+
+    def blocktypes(self, chunksize: int = 1024) -> bytes:
+        """
+        Returns the type byte of every block, read in chunks of chunksize
+        blocks past the cache so a full scan does not evict anything.
+        """
+        if self.mmap:
+            return bytes(self.view[0:self.blocklen*self.bs:self.bs])
+        with self.lock:
+            # Taken before reading, a flush in between writes the same blocks
+            dirty = {blocknum: data[0] for blocknum, data in self.dirty.items()}
+            blocklen = self.blocklen
+        types = bytearray()
+        for x in range(0, blocklen, chunksize):
+            types += self._readat(x*self.bs, chunksize*self.bs)[0::self.bs]
+        types = _fitb(types, blocklen)
+        for blocknum, btype in dirty.items():
+            types[blocknum] = btype
+        return bytes(types)
+
+    def readrun(self, blocknum: int, count: int) -> bytes:
+        """
+        Reads count contiguous blocks starting at blocknum with a single
+        read. The cache is bypassed, blocks not written out yet are taken
+        into account.
+        """
+        if self.mmap:
+            return self.view[blocknum*self.bs:(blocknum+count)*self.bs]
+        dirty = []
+        if self.dirty:
+            dirty = [(x, block) for x in range(blocknum, blocknum+count)
+                     if (block := self.dirty.get(x)) is not None]
+        data = self._readat(blocknum*self.bs, count*self.bs)
+        if len(data) != count*self.bs:
+            data = _fitb(data, count*self.bs)
+        if dirty:
+            data = bytearray(data)
+            for x, block in dirty:
+                data[(x-blocknum)*self.bs:(x-blocknum+1)*self.bs] = block
+        return data
+
+    def _readat(self, offset: int, size: int) -> bytes:
+        # Must be called without the lock held
+        if self.fd is not None:
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def writerun(self, blocknum: int, blocks: list) -> None:
+        """
+        Writes full sized blocks to blocknum and the blocks following it,
+        in file mode with a single write call.
+        """
+        if self.mmap or self.writeback:
+            for x, block in enumerate(blocks):
+                self.writeblock(blocknum+x, block)
+            return
+        with self.lock:
+            _pwriteall(self.fd, blocks, blocknum*self.bs, self.file)
+            self.blocklen = max(self.blocklen, blocknum+len(blocks))
+            for x, block in enumerate(blocks):
+                if blocknum+x in self.cache:
+                    self.cache.update(blocknum+x, bytearray(block))
+            self.writes += 1
+
+    def discard(self, blocknums) -> None:
+        """
+        Empties all the given blocks, blocks next to each other are cleared
+        with a single write.
+        """
+        blocknums = sorted(blocknums)
+        empty = bytes(self.bs)
+        start = 0
+        for x in range(1, len(blocknums)+1):
+            if x == len(blocknums) or blocknums[x] != blocknums[x-1]+1 or x-start == READ_RUN:
+                self.writerun(blocknums[start], [empty]*(x-start))
+                start = x
+
+    def _writeback(self, blocknum: int, data: bytes, write: bool) -> None:
+        with self.lock:
+            if blocknum >= self.blocklen:
+                self.blocklen = blocknum + 1
+            if write:
+                pdata = bytearray(_fitb(data, self.bs))
+                self.dirty[blocknum] = pdata
+                self.cache.update(blocknum, pdata)
+            self.writes += 1
+            overlimit = len(self.dirty) > self.dirtylimit
+        # A journal commits at the end of the transaction instead
+        if overlimit and self.journal is None:
+            self.flush()
+
+    def _writedirty(self) -> None:
+        blocks = sorted(self.dirty)
+        if self.journal is not None:
+            self.journal.append([(x, self.dirty[x]) for x in blocks], self.blocklen)
+        start = 0
+        for x in range(1, len(blocks)+1):
+            if x == len(blocks) or blocks[x] != blocks[x-1]+1:
+                run = [self.dirty[y] for y in blocks[start:x]]
+                _pwriteall(self.fd, run, blocks[start]*self.bs, self.file)
+                start = x
+        self.dirty.clear()
+        if self.file.seek(0, 2) < self.blocklen*self.bs:
+            self.file.truncate(self.blocklen*self.bs)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the writes of one operation, a commit never takes only some of
+        them. Transactions nest, only the outermost one counts. Without a
+        journal it does nothing.
+        """
+        if self.journal is None:
+            yield
+            return
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            self.gate.acquire(False)
+        self.local.depth = depth+1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                self.gate.release()
+                if len(self.dirty) > self.dirtylimit:
+                    self.commit()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Keeps out the transactions of every other thread while it is held,
+        the ones running are waited for. The holder may still run
+        transactions and commit. Without a journal it does nothing.
+        """
+        if self.journal is None:
+            yield
+            return
+        with self.commitlock:
+            self.gate.acquire(True)
+            try:
+                yield
+            finally:
+                self.gate.release()
+
+    def commit(self) -> None:
+        """
+        Writes every block written so far to the journal, syncs it once and
+        then writes the blocks to the file. Callers arriving while a commit
+        runs wait for it and do not commit again if it covered their writes,
+        so concurrent changes share a single sync. Must not be called inside
+        a transaction.
+        """
+        writes = self.writes
+        with self.commitlock:
+            if self.committed >= writes:
+                return
+            self.gate.acquire(True)
+            try:
+                with self.lock:
+                    writes = self.writes
+                    if self.dirty:
+                        self._writedirty()
+                    self.committed = writes
+            finally:
+                self.gate.release()
+            if self.journal.size > JOURNAL_LIMIT:
+                self._checkpoint()
+
+    def checkpoint(self) -> None:
+        """
+        Commits, syncs the file and empties the journal
+        """
+        self.commit()
+        with self.commitlock:
+            self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        # Must be called with the commit lock held
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.journal.reset()
+
+    def flush(self) -> None:
+        """
+        Makes sure everything written so far has reached the file, with a
+        journal this is a commit
+        """
+        if self.journal is not None:
+            self.commit()
+            return
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+            elif self.dirty:
+                self._writedirty()
+            else:
+                self.file.flush()
+
+    def truncate(self, blocklen: int) -> None:
+        """
+        Drops every block from blocklen onwards. In mmap mode the file itself
+        is cut on close. With a journal it checkpoints first, replaying it
+        must not write anything past blocklen.
+        """
+        if self.journal is not None:
+            self.checkpoint()
+        else:
+            self.flush()
+        with self.lock:
+            self.blocklen = blocklen
+            if self.map is None:
+                self.file.truncate(blocklen*self.bs)
+                self.cache.clear()
+                self.writes += 1
+
+    def close(self) -> None:
+        """
+        Flushes the file and gives up the memory map. The file is trimmed back
+        to the number of blocks in use as the mapping grows in bigger steps.
+        A journal is checkpointed.
+        """
+        if self.journal is not None:
+            self.checkpoint()
         else:
-            self.previousblocknum += 1
-        if blocknum >= self.blocklen:
-            self.file.truncate((blocknum+1)*self.bs)
-            self.blocklen = blocknum + 1
-
-        if write:
-            pdata = _fitb(data, self.bs)
-            if blocknum in self.cache:
-                self.cache[blocknum] = bytearray(pdata)
-            self.file.write(pdata)
-        self.lock.release()
+            self.flush()
+        if self.map is not None:
+            self.view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Views are still alive, the mapping goes away with them
+            self.map = None
+            self.file.truncate(self.blocklen*self.bs)
+
+    def instrument(self, metrics: Metrics) -> None:
+        """
+        Counts the blocks read and written by type, the reads reaching the
+        file and the dirty blocks written out in metrics. The methods of
+        this object are wrapped, without it nothing is counted.
+        """
+        readblock, writeblock, readrun = self.readblock, self.writeblock, self.readrun
+        writerun, readat, writedirty = self.writerun, self._readat, self._writedirty
+
+        def countedreadblock(blocknum):
+            data = readblock(blocknum)
+            metrics.count("blockread." + _typename(data[0]))
+            return data
+
+        def countedwriteblock(blocknum, data=b'', write=True):
+            writeblock(blocknum, data, write)
+            metrics.count("blockwrite." + _typename(data[0] if write and data else 0))
+
+        def countedreadrun(blocknum, count):
+            metrics.count("runread")
+            metrics.count("runreadblocks", count)
+            return readrun(blocknum, count)
+
+        def countedwriterun(blocknum, blocks):
+            writerun(blocknum, blocks)
+            for block in blocks:
+                metrics.count("blockwrite." + _typename(block[0]))
+
+        def countedreadat(offset, size):
+            data = readat(offset, size)
+            metrics.count("diskread")
+            metrics.count("diskreadbytes", len(data))
+            return data
+
+        def countedwritedirty():
+            metrics.count("dirtyflush")
+            metrics.count("dirtyflushblocks", len(self.dirty))
+            writedirty()
+
+        self.readblock, self.writeblock, self.readrun = countedreadblock, countedwriteblock, countedreadrun
+        self.writerun, self._readat, self._writedirty = countedwriterun, countedreadat, countedwritedirty
+
+    def cachestats(self) -> dict:
+        """
+        Returns the hits, misses and evictions of the block cache along with
+        its current size and capacity in blocks.
+        """
+        return self.cache.stats()
 
     def __len__(self) -> int:
         return self.blocklen
 
 
-class BVFSFile:
-    def __init__(self, parent: "BVFS", superblock: int, pardirnode: int, fname: str, nm: int) -> None:
+class BVFSFile(io.RawIOBase):
+    """
+    A file inside a BVFS, returned by BVFS.open. It is a raw binary io
+    object so it can be wrapped in io.BufferedReader and friends, and
+    readinto fills a caller supplied buffer straight from the data blocks.
+    Files of up to INLINE_MAX bytes are kept inline in their NodeMetadata
+    block, given as inline, and are moved to data blocks once they grow
+    past it.
+    """
+
+    def __init__(self, parent: "BVFS", superblock: int, pardirnode: int, fname: str, nm: int,
+                 inline: bytes = None) -> None:
+        super().__init__()
         self.superblock = superblock
         self.pardirnode = pardirnode
         self.nm = nm
-        self.cur = superblock
         self.fname = fname
-        self.cursuperblock = 0
-        self.curblock = 0
-        self.curpos = 0
-        self.cursbaddr = superblock
         self.parent = parent
-        if self.superblock != 0:
-            self.superblockblk = parent._blockio.readblock(superblock)
-            if (fb := _intfb(self.superblockblk[24+16:24+16+8])) != 0:
-                self.blockblk = parent._blockio.readblock(fb)
-                self.curblkaddr = fb
-            else:
-                self.blockblk = bytearray(1024)
-                self.curblkaddr = 0
-        else:
-            self.superblockblk = bytearray(1024)
-            self.blockblk = bytearray(1024)
-            self.curblkaddr = 0
+        self.pos = 0
+        self._inline = None if inline is None else bytearray(inline)
+        self._sbs = None  # Block numbers of the superblock chain, built on first use
+        self._size = None
+        self._reserved = deque()  # Blocks set aside for this file, in the order they are used
+        self._keepreserved = False
+        self._recordsize = True  # Keep the NodeMetadata size up to date
+        parent._openfile(self)
+        if parent._metrics is not None:
+            _instrumentfile(self, parent._metrics, "file")
+
+    def preallocate(self, size: int) -> None:
+        """
+        Reserves contiguous blocks for size more bytes to be written, the
+        reservation is kept until the file is closed.
+        """
+        self._reserve(self._filesize()+size)
+        self._keepreserved = True
+
+    def _reserve(self, newsize: int) -> None:
+        # Sets aside the blocks needed to grow the file to newsize. They are
+        # used in file order with every superblock followed by the data
+        # blocks it points to, so both end up next to each other on disk
+        oldblocks = -(-self._filesize()//998)
+        newblocks = -(-newsize//998)
+        newsbs = max(-(-newblocks//123) - len(self._superblocks()), 0)
+        count = newblocks - oldblocks + newsbs - len(self._reserved)
+        if count > 0:
+            start = self.parent._allocaterun(count)
+            self._reserved.extend(range(start, start+count))
+
+    def _takeblock(self) -> int:
+        if self._reserved:
+            return self._reserved.popleft()
+        return self.parent._allocate()
+
+    def _releasereserved(self) -> None:
+        if not self._reserved:
+            return  # Nothing to give back, spares building the free space
+        with self.parent._alloclock:
+            freespace = self.parent._getfreespace()
+            while self._reserved:
+                # Never written so they are still empty on disk
+                freespace.release(self._reserved.pop())
+
+    def close(self) -> None:
+        """
+        Gives back any blocks reserved for this file but not used, and the
+        blocks of the file if it was removed while open and this was the
+        last file open on it
+        """
+        self._releasereserved()
+        self._keepreserved = False
+        self.parent._closefile(self)
+        super().close()
 
-    def write(self, data):
-        if len(data) == 0:
-            return
-        if self._islastposition() or (wasempty := self.superblock == 0) or self.curblkaddr == 0:
-            self._nextblock(True)
-            if wasempty:
-                dirnode = self.pardirnode
-                while True:
-                    blk = self.parent._blockio.readblock(dirnode)
-                    fp = _intfb(blk[24:24+8])
-                    for x in range(992//124):
-                        entry = blk[24+8+x*124:24+8+x*124+124]
-                        if _intfb(entry[:8]) == 0:
-                            continue
-                        else:
-                            if entry[16:16+100].split(b'\0', 1)[0].decode('utf-8') == self.fname:
-                                entry[8:16] = _inttb(self.superblock, 8)
-                                blk[24+8+x*124:24+8+x*124+124] = entry
-                                self.parent._blockio.writeblock(dirnode, blk)
-                                break
-                    if fp != 0:
-                        dirnode = fp
-                    else:
-                        break
-        dataidx = 0
-
-        # Write first chunk logic
-        datalentocopy = 998-self._curposinblock()
-        datachunk = data[0:datalentocopy]
-        self.blockblk[
-            26+self._curposinblock():
-            26+self._curposinblock()+len(datachunk)
-        ] = datachunk
-
-        # If this was the last block just change its length to what it is supposed to be.
-        if _intfb(self.blockblk[24:26]) != 998:
-            self.blockblk[24:26] = _inttb(
-                self._curposinblock()+len(datachunk), 2)
-            dataidx += len(datachunk)
-
-        # Write the block itself
-        self.parent._blockio.writeblock(self.curblkaddr, self.blockblk)
-
-        restchunkswrote = False
-        # Write rest of the chunks logic
-        while dataidx < len(data):
-            self._nextblock(True)
-            datachunk = data[dataidx:dataidx+998]
-            dataidx += 998
-            self.blockblk[26:1024] = datachunk
-            self.blockblk[24:26] = _inttb(998, 2)
-            self.parent._blockio.writeblock(self.curblkaddr, self.blockblk)
-            restchunkswrote = True
-
-        if restchunkswrote:
-            self.blockblk[24:26] = _inttb(len(datachunk), 2)
-            self.parent._blockio.writeblock(self.curblkaddr, self.blockblk)
-
-    def _curposinblock(self):
-        return self.curpos % 998
-
-    def _islastposition(self):
-        return self.curpos % 998 == 0 and self.curpos != 0
-
-    def _islastblock(self):
-        return self.curblock % 122 == 0 and self.curblock != 0
-
-    def _nextblock(self, create: bool = False) -> bool:
-        if not create and self.curblock == 122:
-            pass
-        if self._islastblock() or self.cursbaddr == 0:
-            if not self._nextsuperblock(create):
-                return False
-            self.curblock = -1
-        self.curblock += 1
-        blockid = _intfb(
-            self.superblockblk[24+16+self.curblock*8:24+16+self.curblock*8+8])
-        if blockid == 0:
-            if create:
-                db = _Blocks.createDataBlock(0, b"")
-                dbp = self.parent._allocate()
-                self.parent._blockio.writeblock(dbp, db)
-                self.superblockblk[24+16+self.curblock *
-                                   8:24+16+self.curblock*8+8] = _inttb(dbp, 8)
-                self.parent._blockio.writeblock(
-                    self.cursbaddr, self.superblockblk)
-                self.curblkaddr = dbp
-                self.blockblk = db
-            else:
-                return False
-        else:
-            self.blockblk = self.parent._blockio.readblock(blockid)
-        self.curpos %= 998
+    def readable(self) -> bool:
         return True
 
-    def _nextsuperblock(self, create: bool = False) -> bool:
-        forwardpointer = _intfb(self.superblockblk[24+8:24+16])
-        if forwardpointer == 0 or self.curblkaddr == 0:
-            if create:
-                sbdata = _Blocks.createSuperBlock(self.cursbaddr, 0)
-                sb = self.parent._allocate()
-                self.parent._blockio.writeblock(sb, sbdata)
-                if self.cursbaddr != 0:
-                    self.superblockblk[24+8:24+16] = _inttb(sb, 8)
-                    self.parent._blockio.writeblock(
-                        self.cursbaddr, self.superblockblk)
-                else:
-                    self.superblock = sb
-                self.cursbaddr = sb
-                self.cursuperblock += 1
-                self.superblockblk = sbdata
-                return True
-            else:
-                return False
-        else:
-            self.superblockblk = self.parent._blockio.readblock(forwardpointer)
-            self.cursbaddr = forwardpointer
-            self.cursuperblock += 1
+    def writable(self) -> bool:
         return True
-    
+
+    def _writeinline(self) -> None:
+        bio = self.parent._blockio
+        block = bytearray(bio.readblock(self.nm))
+        block[34:42] = _inttb(len(self._inline), 8)
+        block[48:] = _fitb(_inttb(1, 1)+_inttb(len(self._inline), 2)+b'\0'+self._inline, len(block)-48)
+        bio.writeblock(self.nm, block)
+        self.parent._forgetstat(self.nm)
+
+    def _promote(self) -> None:
+        # Moves the inline content to data blocks, the NodeMetadata block
+        # stops pointing at it only once they are written
+        content = self._inline
+        self._inline = None
+        self._sbs = []
+        self._size = 0
+        pos = self.pos
+        self.pos = 0
+        self.write(content)
+        self.pos = pos
+        bio = self.parent._blockio
+        block = bytearray(bio.readblock(self.nm))
+        block[48:] = bytes(len(block)-48)
+        bio.writeblock(self.nm, block)
+        self.parent._forgetstat(self.nm)
+
+    def write(self, data) -> int:
+        """
+        Writes data at the current position. All the blocks needed are
+        allocated up front, then every data block and superblock touched is
+        written exactly once, a superblock together with its data blocks.
+        """
+        with self.parent._blockio.transaction():
+            return self._write(data)
+
+    def _write(self, data) -> int:
+        data = memoryview(data).cast('B')
+        if (written := len(data)) == 0:
+            return 0
+        if self._inline is not None:
+            if self.pos+written <= INLINE_MAX:
+                if self.pos > len(self._inline):
+                    self._inline += bytes(self.pos-len(self._inline))
+                self._inline[self.pos:self.pos+written] = data
+                self._writeinline()
+                self.pos += written
+                return written
+            self._promote()
+        size = self._filesize()
+        if self.pos > size:
+            # Writing past the end fills the gap with zeros
+            data = memoryview(bytes(self.pos-size)+data)
+            self.pos = size
+        end = self.pos+len(data)
+        newsize = max(size, end)
+        self._reserve(newsize)
+
+        bio = self.parent._blockio
+        sbs = self._superblocks()
+        oldblocks = -(-size//998)
+        first = self.pos//998
+        last = (end-1)//998
+
+        # Block numbers for the blocks being added, in file order
+        newsbs = []
+        newptrs = {}
+        for x in range(oldblocks, last+1):
+            if x % 123 == 0 and x//123 >= len(sbs)+len(newsbs):
+                newsbs.append(self._takeblock())
+            newptrs[x] = self._takeblock()
+        allsbs = sbs + newsbs
+
+        touched = set(range(first//123, last//123+1))
+        if newsbs and sbs:
+            touched.add(len(sbs)-1)  # Its forward pointer changes
+        for sbidx in sorted(touched):
+            sbnum = allsbs[sbidx]
+            if sbidx < len(sbs):
+                sbblk = bytearray(bio.readblock(sbnum))
+            else:
+                sbblk = _Blocks.createSuperBlock(
+                    allsbs[sbidx-1] if sbidx else 0, 0)
+            if sbidx+1 < len(allsbs):
+                sbblk[24+8:24+16] = _inttb(allsbs[sbidx+1], 8)
+
+            blocks = {sbnum: sbblk}
+            for x in range(max(first, sbidx*123), min(last, sbidx*123+122)+1):
+                slot = 24+16+(x-sbidx*123)*8
+                if x < oldblocks:
+                    ptr = _intfb(sbblk[slot:slot+8])
+                else:
+                    ptr = newptrs[x]
+                    sbblk[slot:slot+8] = _inttb(ptr, 8)
+                lo = max(self.pos-x*998, 0)
+                hi = min(end-x*998, 998)
+                contentsize = min(newsize-x*998, 998)
+                chunk = data[x*998+lo-self.pos:x*998+hi-self.pos]
+                if lo == 0 and hi == 998:
+                    blocks[ptr] = _FULLDATAHEADER+chunk
+                elif lo == 0 and hi == contentsize:
+                    blocks[ptr] = _Blocks.createDataBlock(
+                        contentsize, bytes(chunk))
+                else:
+                    block = bytearray(bio.readblock(ptr))
+                    block[26+lo:26+hi] = chunk
+                    block[24:26] = _inttb(contentsize, 2)
+                    blocks[ptr] = block
+            _writeruns(bio, blocks)
+
+        if not sbs:
+            self.superblock = allsbs[0]
+            self.parent._setentrypointer(
+                self.pardirnode, self.fname, self.nm, self.superblock)
+        self._sbs = allsbs
+        if newsize != size and self._recordsize:
+            self.parent._setnodesize(self.nm, newsize)
+        self._size = newsize
+        self.pos = end
+        if not self._keepreserved:
+            self._releasereserved()
+        return written
+
+    def _superblocks(self) -> list:
+        if self._sbs is None:
+            sbs = []
+            sb = self.superblock
+            while sb != 0:
+                sbs.append(sb)
+                sb = _intfb(self.parent._blockio.readblock(sb)[24+8:24+16])
+            self._sbs = sbs
+        return self._sbs
+
+    def _pointers(self, first: int, last: int) -> list:
+        # Data block numbers for the blocks first to last (exclusive) of the file
+        sbs = self._superblocks()
+        ptrs = []
+        for x in range(first//123, min(-(-last//123), len(sbs))):
+            sbptrs = struct.unpack_from(
+                ">123Q", self.parent._blockio.readblock(sbs[x]), 24+16)
+            ptrs.extend(sbptrs[max(first-x*123, 0):last-x*123])
+        return ptrs
+
+    def _filesize(self) -> int:
+        if self._inline is not None:
+            return len(self._inline)
+        if self._size is None:
+            sbs = self._superblocks()
+            self._size = 0
+            if sbs:
+                ptrs = struct.unpack_from(
+                    ">123Q", self.parent._blockio.readblock(sbs[-1]), 24+16)
+                count = ptrs.index(0) if 0 in ptrs else 123
+                self._size = (len(sbs)-1)*123*998
+                if count != 0:
+                    last = self.parent._blockio.readblock(ptrs[count-1])
+                    self._size += (count-1)*998 + min(_intfb(last[24:26]), 998)
+        return self._size
+
+    def _chunks(self, numbytes: int):
+        # Yields views of the payloads from the current position onwards,
+        # blocks that are next to each other on disk are read together
+        if self._inline is not None:
+            yield memoryview(self._inline)[self.pos:self.pos+numbytes]
+            return
+        ptrs = self._pointers(self.pos//998, (self.pos+numbytes-1)//998+1)
+        bio = self.parent._blockio
+        skip = self.pos % 998
+        x = 0
+        while x < len(ptrs):
+            y = x+1
+            while y < len(ptrs) and ptrs[y] == ptrs[y-1]+1 and y-x < READ_RUN:
+                y += 1
+            run = memoryview(bio.readrun(ptrs[x], y-x))
+            for z in range(y-x):
+                n = min(998-skip, numbytes)
+                yield run[z*bio.bs+26+skip:z*bio.bs+26+skip+n]
+                numbytes -= n
+                skip = 0
+            x = y
+
+    def _left(self, numbytes: int) -> int:
+        left = self._filesize()-self.pos
+        if numbytes is None or numbytes < 0 or numbytes > left:
+            numbytes = left
+        return max(numbytes, 0)
+
     def read(self, numbytes: int = None):
-        if self.cursbaddr == 0 or self.curblkaddr == 0:
+        if (numbytes := self._left(numbytes)) == 0:
             return b''
-        if numbytes is not None:
-            bleft = numbytes
+        data = b''.join(self._chunks(numbytes))
+        self.pos += numbytes
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        """
+        Reads into a writable buffer such as a bytearray, memoryview or
+        numpy array and returns the amount of bytes read.
+        """
+        dest = memoryview(buffer).cast('B')
+        if (numbytes := self._left(len(dest))) == 0:
+            return 0
+        done = 0
+        for chunk in self._chunks(numbytes):
+            dest[done:done+len(chunk)] = chunk
+            done += len(chunk)
+        self.pos += numbytes
+        return numbytes
+
+    readinto1 = readinto
+
+    def truncate(self, size: int = None) -> int:
+        """
+        Resizes the file to size bytes, the current position by default.
+        Blocks past the new end are released together, growing fills the
+        file with zeros. The position is left untouched.
+        """
+        with self.parent._blockio.transaction():
+            return self._truncate(size)
+
+    def _truncate(self, size: int = None) -> int:
+        if size is None:
+            size = self.pos
+        if size < 0:
+            raise ValueError(f"Negative size {size}")
+        oldsize = self._filesize()
+        if self._inline is not None and size < oldsize:
+            del self._inline[size:]
+            self._writeinline()
+            return size
+        if size >= oldsize:
+            if size > oldsize:
+                pos = self.pos
+                self.seek(0, 2)
+                self.write(bytes(size-oldsize))
+                self.pos = pos
+            return size
+
+        bio = self.parent._blockio
+        sbs = self._superblocks()
+        keepblocks = -(-size//998)
+        keepsbs = -(-keepblocks//123)
+        freed = self.parent._fileblocks(
+            sbs[keepsbs]) if keepsbs < len(sbs) else []
+        blocks = {}
+        if keepsbs > 0:
+            sbblk = bytearray(bio.readblock(sbs[keepsbs-1]))
+            sbblk[24+8:24+16] = bytes(8)
+            first = 24+16+(keepblocks-(keepsbs-1)*123)*8
+            freed.extend(x for x in struct.unpack_from(
+                f">{(1024-first)//8}Q", sbblk, first) if x != 0)
+            sbblk[first:] = bytes(len(sbblk)-first)
+            blocks[sbs[keepsbs-1]] = sbblk
+
+            lastptr = _intfb(sbblk[first-8:first])
+            lastblk = bytearray(bio.readblock(lastptr))
+            contentsize = size-(keepblocks-1)*998
+            lastblk[24:26] = _inttb(contentsize, 2)
+            lastblk[26+contentsize:] = bytes(998-contentsize)
+            blocks[lastptr] = lastblk
+        _writeruns(bio, blocks)
+
+        if keepsbs == 0:
+            self.superblock = 0
+            self.parent._setentrypointer(
+                self.pardirnode, self.fname, self.nm, 0)
+        self.parent._deallocatemany(freed)
+        self._sbs = sbs[:keepsbs]
+        self._size = size
+        if self._recordsize:
+            self.parent._setnodesize(self.nm, size)
+        return size
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        """
+        Moves the position like any python file. Reaching any byte only needs
+        the cached superblock chain, no data blocks are read on the way.
+        """
+        if whence == 0:
+            newpos = pos
+        elif whence == 1:
+            newpos = self.pos + pos
+        elif whence == 2:
+            newpos = self._filesize() + pos
         else:
-            bleft = 0
-        data = bytearray()
-
-        while bleft > 0 or numbytes is None:
-            if self._islastposition():
-                if not self._nextblock():
-                    return bytes(data)
-            binblk = _intfb(self.blockblk[24:26])
-            chunk = self.blockblk[26+self._curposinblock():26+binblk]
-            if numbytes is not None:
-                data += chunk[:bleft]
-            else:
-                data += chunk
-            bleft -= len(chunk)
-            self.curpos += len(chunk)
-            if len(chunk) == 0:  # Chunk ended
-                return bytes(data)
+            raise ValueError("Whence is not in 0, 1, 2")
+        if newpos < 0:
+            raise ValueError(f"Negative seek position {newpos}")
+        self.pos = newpos
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seekable(self) -> bool:
+        return True
+
+
+def _codec(compression: int):
+    """
+    Returns the (compress, decompress) functions for a compression id
+    """
+    if compression == 1:
+        return zlib.compress, zlib.decompress
+    if compression == 2 and lzma is not None:
+        return lzma.compress, lzma.decompress
+    raise BVFSError(f"Unsupported compression {compression}")
 
-        return bytes(data)
 
-    def seek(self, pos: int, whence: int = 0):
+def _readindex(readat, rawsize: int, framesize: int) -> tuple:
+    """
+    Reads the index at the end of the rawsize bytes of a compressed file
+    through readat(offset, length). Returns the content size and the end
+    offset of every frame. Raises BVFSError if the index is not there, as
+    when the file was not flushed before a crash.
+    """
+    if rawsize == 0:
+        return 0, []
+    if rawsize < 8:
+        raise BVFSError(f"Compressed file of {rawsize} bytes has no index")
+    size = _intfb(readat(rawsize-8, 8))
+    count = -(-size//framesize)
+    if 8+8*count > rawsize:
+        raise BVFSError(
+            f"Compressed file index of {count} frames does not fit in {rawsize} bytes, it was not written")
+    ends = struct.unpack(f">{count}Q", readat(rawsize-8-8*count, 8*count))
+    last = 0
+    for end in ends:
+        if end <= last or end > rawsize-8-8*count:
+            raise BVFSError(f"Compressed file index is invalid, frame ending at {end}")
+        last = end
+    return size, list(ends)
+
+
+class BVFSCompressedFile(io.RawIOBase):
+    """
+    A compressed file inside a BVFS, returned by BVFS.open for files created
+    with a compression. The content is cut in frames of framesize bytes
+    that are compressed one by one and stored one after another like a
+    regular file, followed by the end offset of every frame and the size of
+    the content. Reads and seeks only decompress the frames they touch.
+    Writing is only possible at the end of the file, the last frame is held
+    in memory until it is full. The index is written on flush and close.
+    """
+
+    def __init__(self, raw: BVFSFile, compression: int, framesize: int) -> None:
+        super().__init__()
+        self.raw = raw
+        self.compress, self.decompress = _codec(compression)
+        self.framesize = framesize
+        raw._recordsize = False  # The size recorded is the one of the content
+        self.pos = 0
+        self.tail = bytearray()  # Content past the stored frames, not compressed yet
+        self._frame = (None, b'')  # Last frame decompressed and its number
+        self._dirty = False
+
+        def readat(offset: int, length: int) -> bytes:
+            raw.seek(offset)
+            return raw.read(length)
+        # ends holds the end offset of every stored frame in raw
+        self.size, self.ends = _readindex(readat, raw._filesize(), framesize)
+        if raw.parent._metrics is not None:
+            # The raw file is only used from here, its operations are not
+            # timed on their own but as part of the compressed ones
+            for name in ("read", "readinto", "write", "truncate"):
+                vars(raw).pop(name, None)
+            _instrumentfile(self, raw.parent._metrics, "compressed")
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def _getframe(self, num: int):
+        # All the frames before the tail are full
+        if num >= len(self.ends):
+            return self.tail
+        if self._frame[0] != num:
+            start = self.ends[num-1] if num else 0
+            self.raw.seek(start)
+            self._frame = (num, self.decompress(
+                self.raw.read(self.ends[num]-start)))
+        return self._frame[1]
+
+    def _storeframe(self, frame) -> None:
+        self.raw.seek(self.ends[-1] if self.ends else 0)
+        self.raw.write(self.compress(frame))
+        self.ends.append(self.raw.tell())
+
+    def read(self, numbytes: int = None):
+        left = max(self.size-self.pos, 0)
+        if numbytes is None or numbytes < 0 or numbytes > left:
+            numbytes = left
+        chunks = []
+        while numbytes > 0:
+            num, skip = divmod(self.pos, self.framesize)
+            chunk = self._getframe(num)[skip:skip+numbytes]
+            if not chunk:
+                raise BVFSError(f"Frame {num} is shorter than the index says")
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            numbytes -= len(chunk)
+        return b''.join(chunks)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        dest = memoryview(buffer).cast('B')
+        data = self.read(len(dest))
+        dest[:len(data)] = data
+        return len(data)
+
+    def write(self, data) -> int:
+        """
+        Appends data, the position must be at the end of the file
+        """
+        if self.pos != self.size:
+            raise io.UnsupportedOperation(
+                "Compressed files can only be written at their end")
+        if (written := len(data := memoryview(data).cast('B'))) == 0:
+            return 0
+        if not self.tail and self.size % self.framesize:
+            # The last frame stored is not full, it is taken back to be filled
+            self.tail = bytearray(self._getframe(len(self.ends)-1))
+            self.ends.pop()
+            self._frame = (None, b'')
+        buf = memoryview(self.tail+data)
+        x = 0
+        while len(buf)-x >= self.framesize:
+            self._storeframe(buf[x:x+self.framesize])
+            x += self.framesize
+        self.tail = bytearray(buf[x:])
+        self.size += written
+        self.pos = self.size
+        self._dirty = True
+        return written
+
+    def truncate(self, size: int = None) -> int:
+        if size is None:
+            size = self.pos
+        if size < 0:
+            raise ValueError(f"Negative size {size}")
+        if size > self.size:
+            pos = self.pos
+            self.pos = self.size
+            self.write(bytes(size-self.size))
+            self.pos = pos
+        elif size < self.size:
+            num = size//self.framesize
+            self.tail = bytearray(self._getframe(num)[:size-num*self.framesize])
+            del self.ends[num:]
+            self._frame = (None, b'')
+            self.raw.truncate(self.ends[-1] if self.ends else 0)
+            self.size = size
+            self._dirty = True
+        return size
+
+    def seek(self, pos: int, whence: int = 0) -> int:
         if whence == 0:
-            pos//BLOCK_SIZE
-            cur  # TODO: Complete this
+            newpos = pos
         elif whence == 1:
-            self  # TODO: Complete this
+            newpos = self.pos + pos
+        elif whence == 2:
+            newpos = self.size + pos
         else:
             raise ValueError("Whence is not in 0, 1, 2")
+        if newpos < 0:
+            raise ValueError(f"Negative seek position {newpos}")
+        self.pos = newpos
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self) -> None:
+        """
+        Stores the last frame and writes the index
+        """
+        if self._dirty and not self.closed:
+            with self.raw.parent._blockio.transaction():
+                if self.tail:
+                    self._storeframe(self.tail)
+                    self.tail = bytearray()
+                    self._frame = (None, b'')
+                self.raw.seek(self.ends[-1] if self.ends else 0)
+                self.raw.write(struct.pack(
+                    f">{len(self.ends)}Q", *self.ends)+_inttb(self.size, 8))
+                self.raw.truncate()
+                self.raw.parent._setnodesize(self.raw.nm, self.size)
+            self._dirty = False
+        super().flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            super().close()  # Flushes first
+            self.raw.close()
 
 
 # The Standard BVFS class to perform all the IO operations
+# BVFS methods timed when metrics are on
+_TIMED = ("open", "exists", "lsdir", "stat", "scandir", "mkdir", "mkdir_many", "create_many", "rmdir",
+          "rmfile", "flush", "sync", "export_tree", "import_tree", "compact")
+
+
 class BVFS:
     """
     BVFS class allows you to open a file by its name and interract
     with its underlying filesystem. Cache limit can be set to set
-    the amount of blocks it should cache. This is also thread safe.
+    the amount of blocks it should cache, cache bytes optionally caps
+    the same cache in bytes. When mmap is set the file is memory mapped
+    and blocks are handed out without copying. Writeback keeps written
+    blocks in memory until flush or close, see BlockIO for details.
+    Free blocks are tracked in memory, the index is built on first use by
+    scanning the block types. With savefreemap the index is stored in the
+    root block on close when it fits, and the next open loads it instead of
+    scanning. Only use it when every program opening the file does the
+    same, as an older one would leave a stale index behind.
+    Resolved directory paths, including the ones that do not exist, are
+    cached up to pathcachesize of them, the entries of up to dircachesize
+    directories and the metadata returned by stat and scandir up to
+    statcachesize nodes. Directories in use are kept past dircachesize.
+    Every directory used also keeps a small lock in memory until it is
+    removed, a few hundred bytes each.
+    This is also thread safe. Every directory has a reader-writer lock,
+    lookups share it and changes to its entries take it exclusively, so
+    threads working in different directories or streaming different files
+    do not wait on each other. A single file object should only be used by
+    one thread at a time.
+    With journal set every change is first written to a journal kept in
+    filename + "-journal". Changes are made durable together by sync, or
+    once enough of them are held in memory, each filesystem operation either
+    fully or not at all. If the process dies the next open replays the
+    journal instead of refusing to open the locked filesystem. It implies
+    writeback and turns mmap off.
+    metrics, True or a Metrics object, turns on instrumentation: blocks
+    read and written by type, allocator and directory lookup work, and the
+    latency of every public method and file operation, see metrics. Without
+    it none of this costs anything.
     """
 
-    def __init__(self, filename: str, cachelimit: int = 1000) -> None:
+    def __init__(self, filename: str, cachelimit: int = 1000, cachebytes: int = None, mmap: bool = False,
+                 writeback: bool = False, savefreemap: bool = False, pathcachesize: int = 4096,
+                 statcachesize: int = 65536, journal: bool = False, metrics: Metrics = None,
+                 dircachesize: int = 4096) -> None:
+        self._metrics = Metrics() if metrics is True else metrics or None
         self._fp = open(filename, 'r+b')
-        self._blockio = BlockIO(self._fp, cachesize=cachelimit)
-        # This variable is used to keep the track of the first free block contrary to its name.
-        self._lastfreeblock = 0
+        self._journal = None
+        jpath = filename + "-journal"
+        locked = _fitb(self._fp.read(40), 40)[38]
+        replayed = False
+        if os.path.exists(jpath) and (locked == JOURNAL_LOCK or os.path.getsize(jpath) > 0):
+            # Left open with a journal, replaying it brings the image to its
+            # last commit. Records are replayed even if the lock flag never
+            # reached the disk, they were reported durable.
+            self._openjournal(jpath)
+            self._journal.replay(self._fp)
+            replayed = True
+        elif locked == JOURNAL_LOCK:
+            raise LockedError(
+                "Current file system is locked and its journal is missing please run a full recovery on the filesystem to access it")
+        if journal and self._journal is None:
+            self._openjournal(jpath)
+        elif not journal and self._journal is not None:
+            self._journal.close(remove=True)
+            self._journal = None
+        self._blockio = BlockIO(
+            self._fp, cachesize=cachelimit, cachebytes=cachebytes, mmap=mmap, writeback=writeback,
+            journal=self._journal)
+        if self._metrics is not None:
+            self._blockio.instrument(self._metrics)
+            for name in _TIMED:
+                setattr(self, name, self._metrics.timed(name, getattr(self, name)))
+        self._freespace = None
+        self._savefreemap = savefreemap
+        self._dirindex = OrderedDict()  # First directory block to its _directory index
+        self._dircachesize = dircachesize
+        self._dirindexlock = Lock()
+        self._dentries = _DentryCache(pathcachesize)
+        self._dirlocks = {}  # First directory block to its _RWLock
+        self._deaddirs = set()  # First blocks of removed directories, until a new one starts there
+        self._dirgen = 0  # Bumped whenever a directory is removed or moved
+        self._dirlockslock = Lock()
+        self._alloclock = Lock()  # Guards the free space index
+        self._opennodes = {}  # NodeMetadata block to the _OpenNode of the files open on it
+        self._openlock = Lock()
+        self._stats = OrderedDict()  # NodeMetadata block to (type, size, perms, uid, gid)
+        self._statcachesize = statcachesize
+        self._statgen = 0  # Bumped whenever a cached node changes
+        self._statlock = Lock()
 
         block = self._blockio.readblock(0)  # Read the root block
 
@@ -420,287 +1942,981 @@ class BVFS:
             raise VersionError(
                 f"Current library supports bvfs upto version {FS_VERSION} but the file being read is at version {ver}.")
         # Check for locked flag
-        if block[38] != 0:
+        if block[38] != 0 and not (replayed and block[38] == JOURNAL_LOCK):
             raise LockedError(
                 "Current file system is locked please run a full recovery on the filesystem to access it")
 
         # Read the pointer to root directory node
         self._rootdir = _intfb(block[30:38])
-        block[38] = 255  # Set the locked flag
+        if block[39] != 0:
+            # A free map saved on close, it is dropped from the root block as
+            # it goes stale as soon as anything is allocated
+            self._freespace = _FreeSpace.fromdata(block[40:])
+            block[39:] = bytes(len(block)-39)
+        block[38] = 255 if self._journal is None else JOURNAL_LOCK  # Set the locked flag
         self._blockio.writeblock(0, block)   # Write the lock back
+        if self._journal is not None:
+            # The lock flag must be on disk before anything is committed, it
+            # is what tells the next open to replay the journal
+            self._blockio.checkpoint()
+        else:
+            self._blockio.flush()
+
+    def _openjournal(self, path: str) -> None:
+        self._journal = _Journal(path)
+        if not self._journal.lock():
+            self._journal.close()
+            self._journal = None
+            raise LockedError("Current file system is in use by another process")
+
+    def _getfreespace(self) -> _FreeSpace:
+        # Must be called with the allocation lock held
+        if self._freespace is None:
+            self._freespace = _FreeSpace(self._blockio.blocktypes())
+            if self._metrics is not None:
+                self._metrics.count("freespacebuild")
+        return self._freespace
 
     def _allocate(self) -> int:
-        while True:
-            if self._lastfreeblock >= len(self._blockio):
-                self._blockio.writeblock(self._lastfreeblock, write=False)
-                block = b'\0'
-            else:
-                block = self._blockio.readblock(self._lastfreeblock)
+        with self._alloclock:
+            return self._getfreespace().allocate()
 
-            if block[0] == 0:
-                self._lastfreeblock += 1
-                return self._lastfreeblock - 1
-            self._lastfreeblock += 1
+    def _allocaterun(self, count: int) -> int:
+        """
+        Allocates count contiguous blocks and returns the first one
+        """
+        with self._alloclock:
+            freespace = self._getfreespace()
+            blocknum = freespace.allocaterun(count)
+            scanned = freespace.scanned
+        if self._metrics is not None:
+            self._metrics.observe("allocscan", scanned)
+        return blocknum
 
     def _deallocate(self, blocknum: int) -> None:
         self._blockio.writeblock(blocknum, b'')
-        self._lastfreeblock = min(self._lastfreeblock, blocknum)
-
-    def _writedirectorynode(self, blockint: int, nm: int, sb: int, name: str):
-        block = self._blockio.readblock(blockint)
-        bint = blockint
-        offset = 0
-        entry = _Blocks.createDirectoryEntry(nm, sb, name)
-        while True:
-            centry = block[24+8+offset:24+8+offset+124]
-            if _intfb(centry[0:8]) == 0:
-                block[24+8+offset:24+8+offset+124] = entry
-                self._blockio.writeblock(bint, block)
+        self._forgetstat(blocknum)
+        with self._alloclock:
+            self._getfreespace().release(blocknum)
+
+    def _deallocatemany(self, blocknums) -> None:
+        # Clears runs of blocks with single writes, released from the top
+        # down so blocks at the end of the image shrink it right away
+        self._blockio.discard(blocknums)
+        for blocknum in blocknums:
+            self._forgetstat(blocknum)
+        with self._alloclock:
+            freespace = self._getfreespace()
+            for blocknum in sorted(blocknums, reverse=True):
+                freespace.release(blocknum)
+
+    def _forgetstat(self, nm: int) -> None:
+        # Call it whenever a NodeMetadata block changes or is freed
+        with self._statlock:
+            self._statgen += 1
+            self._stats.pop(nm, None)
+
+    def _setnodesize(self, nm: int, size: int) -> None:
+        block = bytearray(self._blockio.readblock(nm))
+        block[34:42] = _inttb(size, 8)
+        self._blockio.writeblock(nm, block)
+        self._forgetstat(nm)
+
+    def _openfile(self, fp: BVFSFile) -> None:
+        # Call it with the parent directory locked, so the node can not be
+        # removed in between
+        with self._openlock:
+            if (node := self._opennodes.get(fp.nm)) is None:
+                node = self._opennodes[fp.nm] = _OpenNode()
+            node.files.add(fp)
+
+    def _closefile(self, fp: BVFSFile) -> None:
+        with self._openlock:
+            if (node := self._opennodes.get(fp.nm)) is None:
                 return
-            offset += 124
-            if offset == 124*8:
-                if (fp := _intfb(block[24:24+8])) == 0:
-                    # We have reached the end of this entry, need to allocate new block
-                    bint2 = self._allocate()
-                    block[24:24+8] = bint2.to_bytes(8, 'big')
-                    self._blockio.writeblock(bint, block)
-                    bint = bint2
-                    block = bytearray(_Blocks.createDirectoryBlock())
-                    offset = 0
+            node.files.discard(fp)
+            if node.files:
+                return
+            del self._opennodes[fp.nm]
+        if node.removed:
+            with self._blockio.transaction():
+                self._deallocatemany(self._fileblocks(node.ptr)+[fp.nm])
+
+    def _removedptr(self, nm: int, ptr: int) -> bool:
+        # Records the first superblock of a node removed while open, returns
+        # False when it was not removed
+        with self._openlock:
+            if (node := self._opennodes.get(nm)) is None or not node.removed:
+                return False
+            node.ptr = ptr
+            return True
+
+    def _dirlock(self, dirnode: int) -> _RWLock:
+        with self._dirlockslock:
+            # A path resolved before its directory was removed must not lock
+            # whatever took the block since
+            if dirnode in self._deaddirs:
+                raise DirectoryNotFound("Given Path does not exist")
+            if (lock := self._dirlocks.get(dirnode)) is None:
+                lock = self._dirlocks[dirnode] = _RWLock()
+            return lock
+
+    @contextmanager
+    def _locked(self, dirnode: int, write: bool = False):
+        # Holds the lock of the directory starting at dirnode, shared unless
+        # write is set. Fails if the directory was removed while waiting.
+        lock = self._dirlock(dirnode)
+        lock.acquire(write)
+        try:
+            if lock.removed:
+                raise DirectoryNotFound("Given Path does not exist")
+            yield
+        finally:
+            lock.release()
+
+    @contextmanager
+    def _lockedpaths(self, paths: list, write: bool = False):
+        """
+        Resolves the directory paths and holds their locks in the order
+        given, yielding the first block of each. A directory removed or moved
+        meanwhile may have left its block to another one, the paths are then
+        resolved again.
+        """
+        while True:
+            generation = self._dirgen
+            locks = []
+            try:
+                dirnodes = [self._opendirectory(path) for path in paths]
+                for dirnode in dirnodes:
+                    lock = self._dirlock(dirnode)
+                    lock.acquire(write)
+                    locks.append(lock)
+                    if lock.removed:
+                        raise DirectoryNotFound("Given Path does not exist")
+            except BaseException as e:
+                for lock in reversed(locks):
+                    lock.release()
+                if isinstance(e, DirectoryNotFound) and self._dirgen != generation:
+                    continue
+                raise
+            if self._dirgen == generation:
+                break
+            for lock in reversed(locks):
+                lock.release()
+        try:
+            yield dirnodes
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def _lockedpath(self, path: str, write: bool = False):
+        with self._lockedpaths([path], write) as (dirnode,):
+            yield dirnode
+
+    def _fileblocks(self, superblock: int) -> list:
+        # All the superblocks and data blocks of the file starting at superblock
+        blocks = []
+        while superblock != 0:
+            sbblk = self._blockio.readblock(superblock)
+            blocks.append(superblock)
+            blocks.extend(x for x in struct.unpack_from(
+                ">123Q", sbblk, 24+16) if x != 0)
+            superblock = _intfb(sbblk[24+8:24+16])
+        return blocks
+
+    def _directory(self, dirnode: int) -> _Directory:
+        """
+        Returns the in memory view of the directory starting at dirnode, it
+        is built from the directory blocks on first access and kept in sync
+        by every method changing directory entries.
+        """
+        with self._dirindexlock:
+            if (d := self._dirindex.get(dirnode)) is not None:
+                self._dirindex.move_to_end(dirnode)
+                return d
+        d = _Directory()
+        bint = dirnode
+        while bint != 0:
+            blk = self._blockio.readblock(bint)
+            if blk[0] != 4:
+                raise DirectoryNotFound("Given Path does not exist")
+            d.chain.append(bint)
+            d.used[bint] = 0
+            for x in range(992//124):
+                entry = blk[24+8+x*124:24+8+x*124+124]
+                if (nm := _intfb(entry[:8])) != 0:
+                    d.entries.setdefault(_entryname(entry), _DirEntry(
+                        nm, _intfb(entry[8:16]), bint, x))
+                    d.used[bint] += 1
                 else:
-                    bint = fp
-                    block = self._blockio.readblock(fp)
-                    offset = 0
+                    d.free.append((bint, x))
+            bint = _intfb(blk[24:24+8])
+        d.free.reverse()
+        with self._dirindexlock:
+            self._dirindex[dirnode] = d
+            self._trimdirindex()
+        if self._metrics is not None:
+            self._metrics.observe("dirblockswalked", len(d.chain))
+        return d
+
+    def _trimdirindex(self) -> None:
+        # Must be called with the index lock held. Only directories whose
+        # lock nobody holds or waits for are dropped, a holder may still be
+        # changing the index it got. Anyone else has to take the index lock
+        # to get one and builds it again from the blocks.
+        excess = len(self._dirindex) - max(self._dircachesize, 1)
+        idle = []
+        for dirnode in self._dirindex:
+            if len(idle) >= excess:
+                break
+            lock = self._dirlocks.get(dirnode)
+            if lock is None or not (lock.readers or lock.writer is not None or lock.waiting):
+                idle.append(dirnode)
+        for dirnode in idle:
+            del self._dirindex[dirnode]
 
-    def _createnodemetadata(self, ntype: int, permissions: int = 0, groupid: int = 0, userid: int = 0, fsize: int = 0) -> int:
+    def _direntries(self, dirnode: int) -> dict:
+        return self._directory(dirnode).entries
+
+    def _writedirectorynode(self, blockint: int, nm: int, sb: int, name: str):
+        self._writedirectorynodes(blockint, [(nm, sb, name)])
+
+    def _writedirectorynodes(self, dirnode: int, entries: list) -> None:
+        """
+        Adds (nm, sb, name) entries to a directory filling free slots first,
+        blocks are appended to the chain when it is full. Every directory
+        block touched is written once.
+        """
+        d = self._directory(dirnode)
+        blocks = {}
+        for nm, sb, name in entries:
+            if (slot := d.takeslot()) is None:
+                # We have reached the end of this entry, need to allocate new block
+                bint = self._allocate()
+                tail = blocks.get(d.chain[-1]) or bytearray(
+                    self._blockio.readblock(d.chain[-1]))
+                tail[24:24+8] = _inttb(bint, 8)
+                blocks[d.chain[-1]] = tail
+                blocks[bint] = _Blocks.createDirectoryBlock()
+                d.chain.append(bint)
+                d.used[bint] = 0
+                d.free.extend((bint, x) for x in range(992//124-1, -1, -1))
+                slot = d.takeslot()
+            bint, x = slot
+            if bint not in blocks:
+                blocks[bint] = bytearray(self._blockio.readblock(bint))
+            blocks[bint][24+8+x*124:24+8+x*124 +
+                         124] = _Blocks.createDirectoryEntry(nm, sb, name)
+            d.used[bint] += 1
+            d.entries[name] = _DirEntry(nm, sb, bint, x)
+        _writeruns(self._blockio, blocks)
+
+    def _removeentry(self, dirnode: int, name: str) -> _DirEntry:
+        d = self._directory(dirnode)
+        entry = d.entries.pop(name)
+        d.used[entry.block] -= 1
+        if d.used[entry.block] == 0 and entry.block != dirnode:
+            # The block is empty now, unlink it from the chain
+            x = d.chain.index(entry.block)
+            prevblk = self._blockio.readblock(d.chain[x-1])
+            prevblk[24:24+8] = self._blockio.readblock(entry.block)[24:24+8]
+            self._blockio.writeblock(d.chain[x-1], prevblk)
+            self._deallocate(entry.block)
+            del d.chain[x], d.used[entry.block]
+        else:
+            blk = self._blockio.readblock(entry.block)
+            blk[24+8+entry.slot*124:24+8+entry.slot*124+124] = bytes(124)
+            self._blockio.writeblock(entry.block, blk)
+            d.free.append((entry.block, entry.slot))
+        return entry
+
+    def _setentrypointer(self, dirnode: int, name: str, nm: int, ptr: int) -> None:
+        # Points the entry of the node with metadata nm at its first superblock
+        if self._removedptr(nm, ptr):
+            return
+        try:
+            with self._locked(dirnode, write=True):
+                entries = self._direntries(dirnode)
+                if (entry := entries.get(name)) is None or entry.nm != nm:
+                    self._removedptr(nm, ptr)  # Removed since
+                    return
+                blk = self._blockio.readblock(entry.block)
+                blk[24+8+entry.slot*124+8:24+8+entry.slot*124+16] = _inttb(ptr, 8)
+                self._blockio.writeblock(entry.block, blk)
+                entries[name] = entry._replace(ptr=ptr)
+        except DirectoryNotFound:
+            # Removed since, and its directory after it
+            if not self._removedptr(nm, ptr):
+                raise
+
+    def _createnodemetadata(self, ntype: int, permissions: int = 0, groupid: int = 0, userid: int = 0, fsize: int = 0,
+                            compression: int = 0, framesize: int = 0, inline: bytes = None) -> int:
         block = _Blocks.createNodeMetadataBlock(
-            permissions, groupid, userid, fsize, ntype)
+            permissions, groupid, userid, fsize, ntype, compression, framesize, inline)
         bint = self._allocate()
         self._blockio.writeblock(bint, block)
         return bint
 
     def _opendirectory(self, dirname: str) -> int:
-        dn = dirname.split("/")
+        path = _normpath(dirname)
+        generation = self._dentries.generation
+        if (cached := self._dentries.get(path)) is not None:
+            if self._metrics is not None:
+                self._metrics.count("lookupcached")
+            if isinstance(cached, tuple):
+                raise DirectoryNotFound(cached[1])
+            return cached
+        if self._metrics is not None:
+            self._metrics.observe("lookupdepth", path.count("/"))
         cnode = self._rootdir
-        for x in dn[1:]:
+        prefix = ""
+        for x in path.split("/")[1:]:
             if len(x) == 0:
                 continue
-            block = self._blockio.readblock(cnode)
-            offset = 0
-            while True:
-                if (nm := _intfb(block[24+8+offset:24+8+offset+8])) != 0:
-                    fname = block[24+8+offset+16:24+8+offset +
-                                  16+100].split(b'\0', 1)[0].decode('utf-8')
-                    if fname == x:
-                        nmblock = self._blockio.readblock(nm)
-                        if nmblock[24+18] == 2:
-                            cnode = _intfb(block[24+8+offset+8:24+8+offset+16])
-                            break
-                        else:
-                            raise DirectoryNotFound("Given path is a file")
-                offset += 124
-                if offset == 124*8:
-                    if (fp := _intfb(block[24:24+8])) != 0:
-                        cnode = fp
-                        block = self._blockio.readblock(cnode)
-                        offset = 0
-                        continue
-                    else:
-                        raise DirectoryNotFound("Given Path does not exist")
+            prefix += "/" + x
+            with self._locked(cnode):
+                entry = self._direntries(cnode).get(x)
+            if entry is None:
+                message = "Given Path does not exist"
+            elif self._blockio.readblock(entry.nm)[24+18] != 2:
+                message = "Given path is a file"
+            else:
+                cnode = entry.ptr
+                continue
+            self._dentries.putmissing(path, prefix, message, generation)
+            raise DirectoryNotFound(message)
+        self._dentries.putdir(path, cnode, generation)
         return cnode
 
-    def _purge_empty_directory_blocks(self, dirnum: int):
-        preventry = 0
-        prevblk = b''
-        dirnode = dirnum
-        while True:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            totalentries = 0
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if _intfb(entry[:8]) == 0:
-                    continue
-                else:
-                    totalentries += 1
-                    break
-            if totalentries == 0 and not dirnode == dirnum:
-                prevblk[24:24+8] = blk[24:24+8]
-                self._blockio.writeblock(preventry, prevblk)
-                self._deallocate(dirnode)
-            if fp != 0:
-                prevblk = blk
-                preventry = dirnode
-                dirnode = fp
-            else:
-                break
+    def _groupbyparent(self, paths) -> list:
+        # Splits paths into (parent, [(name, path)]) groups, shallow parents
+        # first so parents created in the same batch exist when needed
+        groups = {}
+        for path in paths:
+            pdir, name = path.rsplit("/", 1)
+            names = groups.setdefault(_normpath(pdir), {})
+            if name in names:
+                raise FileAlreadyExists(f"{path} is given more than once")
+            names[name] = path
+        return sorted(((pdir, list(names.items())) for pdir, names in groups.items()),
+                      key=lambda g: g[0].count("/") - (g[0] == "/"))
+
+    def _checknew(self, pdirnode: int, names: list) -> None:
+        entries = self._direntries(pdirnode)
+        for name, path in names:
+            if name in entries:
+                raise FileAlreadyExists(f"{path} already exists")
 
     def mkdir(self, dirname: str):
         """
         Create a directory with the given dirname the dirname
         is split by forward slash
         """
-        pdir, cdir = dirname.rsplit("/", 1)
-        pdirnode = self._opendirectory(pdir)
-        nm = self._createnodemetadata(2)
-        dirp = self._allocate()
-        self._blockio.writeblock(dirp, _Blocks.createDirectoryBlock())
-        self._writedirectorynode(pdirnode, nm, dirp, cdir)
+        self.mkdir_many([dirname])
+
+    def mkdir_many(self, dirnames) -> None:
+        """
+        Creates all the given directories, a parent may be created by the
+        same call. The metadata and directory blocks of a parent's new
+        children are written as one run and each of the parent's directory
+        blocks is written once per call.
+        """
+        for pdir, names in self._groupbyparent(dirnames):
+            with self._blockio.transaction(), self._lockedpath(pdir, write=True) as pdirnode:
+                self._checknew(pdirnode, names)
+                start = self._allocaterun(2*len(names))
+                blocks = {}
+                entries = []
+                for x, (name, _) in enumerate(names):
+                    nm = start+2*x
+                    blocks[nm] = _Blocks.createNodeMetadataBlock(0, 0, 0, 0, 2)
+                    blocks[nm+1] = _Blocks.createDirectoryBlock()
+                    entries.append((nm, nm+1, name))
+                _writeruns(self._blockio, blocks)
+                with self._dirlockslock:
+                    self._deaddirs.difference_update(sb for _, sb, _ in entries)
+                self._writedirectorynodes(pdirnode, entries)
+                for _, path in names:
+                    self._dentries.invalidate(_normpath(path))
+
+    def create_many(self, files: dict) -> None:
+        """
+        Creates the files given as a mapping of path to contents, the parent
+        directories must exist. Directory blocks are written once per call
+        for each parent like in mkdir_many.
+        """
+        for pdir, names in self._groupbyparent(files):
+            with self._blockio.transaction(), self._lockedpath(pdir, write=True) as pdirnode:
+                self._checknew(pdirnode, names)
+                start = self._allocaterun(len(names))
+                # Small files go inline, others get their blocks below
+                _writeruns(self._blockio, {start+x: _Blocks.createNodeMetadataBlock(
+                    0, 0, 0, len(files[path]), 1, inline=bytes(files[path]) if len(files[path]) <= INLINE_MAX else None)
+                    for x, (_, path) in enumerate(names)})
+                entries = []
+                for x, (name, path) in enumerate(names):
+                    sb = 0
+                    if len(files[path]) > INLINE_MAX:
+                        # Written before the entry exists so its pointer goes in with it
+                        fp = BVFSFile(self, 0, pdirnode, name, start+x)
+                        fp.write(files[path])
+                        fp.close()
+                        sb = fp.superblock
+                    entries.append((start+x, sb, name))
+                self._writedirectorynodes(pdirnode, entries)
+                for _, path in names:
+                    self._dentries.invalidate(_normpath(path))
 
     def exists(self, nodename: str) -> bool:
         """
         Checks if a path exists
         """
-        pdirnode, fname2 = nodename.rsplit("/", 1)
-        dirnode = self._opendirectory(pdirnode)
-        while True:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if _intfb(entry[:8]) == 0:
-                    continue
-                elif entry[16:16+100].split(b'\0', 1)[0].decode('utf-8') == fname2:
-                    return True
-            if fp != 0:
-                dirnode = fp
-            else:
-                break
-        return False
+        pdir, fname = nodename.rsplit("/", 1)
+        with self._lockedpath(pdir) as pdirnode:
+            return fname in self._direntries(pdirnode)
 
     def lsdir(self, dirname: str):
         """
         Lists a directory
         """
-        dirnode = self._opendirectory(dirname)
-        ls = []
-        while True:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if _intfb(entry[:8]) == 0:
-                    continue
-                else:
-                    ls.append(entry[16:16+100].split(b'\0', 1)
-                              [0].decode('utf-8'))
-            if fp != 0:
-                dirnode = fp
-            else:
-                break
-        return ls
+        with self._lockedpath(dirname) as dirnode:
+            return list(self._direntries(dirnode))
 
     def rmdir(self, dirname: str):
         """
         Deletes a directory, Only works on empty directories
         """
 
-        pdirnode = dirnode = self._opendirectory(dirname)
-        while True:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if _intfb(entry[:8]) == 0:
-                    continue
-                else:
-                    raise DirectoryNotEmpty(
-                        "Attempt to remove a directory that is not empty.")
-            if fp != 0:
-                dirnode = fp
-            else:
-                break
-
-        # Code to actually remove the directory
-        dirnode = pdirnode
-        while True:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            self._deallocate(dirnode)
-            if fp != 0:
-                dirnode = fp
-            else:
-                break
-
-        # Code to remove directory entry from parent
-        parentdir = self._opendirectory(dirname.rsplit("/", 1)[0])
-        fname = dirname.rsplit("/", 1)[1]
-        dirnode = parentdir
-        rmpentry = True
-        while rmpentry:
-            blk = self._blockio.readblock(dirnode)
-            fp = _intfb(blk[24:24+8])
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if _intfb(entry[:8]) == 0:
-                    continue
-                else:
-                    if entry[16:16+100].split(b'\0', 1)[0].decode('utf-8') == fname:
-                        nmpointer = _intfb(entry[:8])
-                        self._deallocate(nmpointer)
-                        blk[24+8+x*124:24+8+x*124+124] = bytearray(124)
-                        self._blockio.writeblock(dirnode, blk)
-                        rmpentry = False
-                        break
-            if fp != 0:
-                dirnode = fp
-            else:
-                break
-
-        # Purge Empty directory nodes in the parent directory
-        self._purge_empty_directory_blocks(parentdir)
-
-    def open(self, filename: str, mode: str):
+        pdir, fname = dirname.rsplit("/", 1)
+        # Parent before child, the order every lock holder follows
+        with self._blockio.transaction(), self._lockedpaths([pdir, dirname], write=True) as (parentdir, dirnode):
+            if (entry := self._direntries(parentdir).get(fname)) is None or entry.ptr != dirnode:
+                raise DirectoryNotFound("Given Path does not exist")
+            if self._direntries(dirnode):
+                raise DirectoryNotEmpty(
+                    "Attempt to remove a directory that is not empty.")
+
+            # The lock and index go before any block is released, a directory
+            # made in a reused block must not find them. Anyone still waiting
+            # for the directory fails once it is released, anyone coming later
+            # with the old block number is turned away by the tombstone.
+            chain = self._directory(dirnode).chain
+            with self._dirlockslock:
+                self._dirlocks.pop(dirnode).removed = True
+                self._deaddirs.add(dirnode)
+            with self._dirindexlock:
+                self._dirindex.pop(dirnode, None)
+
+            # Code to remove directory entry from parent, a parent directory
+            # block left empty is unlinked on the way
+            self._deallocate(self._removeentry(parentdir, fname).nm)
+            self._dentries.invalidate(_normpath(dirname))
+            self._dirgen += 1
+            for bint in chain:
+                self._deallocate(bint)
+
+    def open(self, filename: str, mode: str, compression: str = None):
         """
         Classic python like open function for opening a pythonic file api based object.
+        A file created with compression set to one of COMPRESSIONS is
+        stored compressed, see BVFSCompressedFile. Compressed files are
+        recognized when opened again.
         """
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}")
         if self.exists(filename):
             if 'x' in mode:
                 raise FileAlreadyExists(
                     "Can not create the file in exclusive mode as the file already exists")
-            elif 'w' in mode:
-                self.rmfile(filename)
         else:
             if 'r' in mode or '+' in mode or 'a' in mode:
                 raise FileNotFound()
 
         if 'w' in mode or 'x' in mode:
             pdir, fname = filename.rsplit("/", 1)
-            nm = self._createnodemetadata(1)
-            sb = 0
-            pdirnode = self._opendirectory(pdir)
-            self._writedirectorynode(pdirnode, nm, sb, fname)
-            return BVFSFile(self, 0, pdirnode, fname, nm)
+            with self._blockio.transaction(), self._lockedpath(pdir, write=True) as pdirnode:
+                # Checked again, it may have been created since. No path is
+                # resolved while the lock is held as that locks its parents
+                if fname in self._direntries(pdirnode):
+                    if 'x' in mode:
+                        raise FileAlreadyExists(
+                            "Can not create the file in exclusive mode as the file already exists")
+                    self._removefile(pdirnode, fname, filename)
+                codec = COMPRESSIONS.get(compression, 0)
+                if codec:
+                    _codec(codec)  # Fails before anything is created if unavailable
+                inline = None if codec else b''
+                nm = self._createnodemetadata(
+                    1, compression=codec, framesize=FRAME_SIZE if codec else 0, inline=inline)
+                self._writedirectorynode(pdirnode, nm, 0, fname)
+                self._dentries.invalidate(_normpath(filename))
+                fp = BVFSFile(self, 0, pdirnode, fname, nm, inline)
+            if codec:
+                return BVFSCompressedFile(fp, codec, FRAME_SIZE)
+            return fp
         elif 'r' in mode or 'a' in mode:
             pdir, fname = filename.rsplit("/", 1)
-            pdirnode = self._opendirectory(pdir)
-            while True:
-                blk = self._blockio.readblock(pdirnode)
-                for x in range(992//124):
-                    entry = blk[24+8+x*124:24+8+x*124+124]
-                    if (nmnum := _intfb(entry[:8])) != 0:
-                        if entry[16:16+100].split(b'\0', 1)[0].decode('utf-8') == fname:
-                            nmblk = self._blockio.readblock(nmnum)
-                            if nmblk[24+18] != 1:
-                                raise FileNotFound(
-                                    "Provided path exists but is not a file")
-                            else:
-                                return BVFSFile(self, _intfb(entry[8:16]), pdirnode, fname, nmnum)
-                if (fp := _intfb(blk[24:24+8])) != 0:
-                    pdirnode = fp
-                else:
+            with self._lockedpath(pdir) as pdirnode:
+                if (entry := self._direntries(pdirnode).get(fname)) is None:
                     raise FileNotFound("File does not exist")
+                nmblk = self._blockio.readblock(entry.nm)
+                if nmblk[24+18] != 1:
+                    raise FileNotFound("Provided path exists but is not a file")
+                fp = self._fileobject(pdirnode, fname, entry, nmblk)
+            if 'a' in mode:
+                fp.seek(0, 2)
+            return fp
+
+    def _fileobject(self, pdirnode: int, fname: str, entry: _DirEntry, nmblk: bytes):
+        # The file object for an existing file given its NodeMetadata block
+        inline = None
+        if nmblk[48] & 1:
+            inline = nmblk[52:52+_intfb(nmblk[49:51])]
+        fp = BVFSFile(self, entry.ptr, pdirnode, fname, entry.nm, inline)
+        if nmblk[24+19] != 0:
+            try:
+                fp = BVFSCompressedFile(
+                    fp, nmblk[24+19], _intfb(nmblk[24+20:24+24]))
+            except BaseException:
+                fp.close()
+                raise
+        return fp
+
+    def _nodestats(self, pdirnode: int, entries: list) -> list:
+        """
+        Returns a NodeStat for each (name, entry) of the directory starting
+        at pdirnode. NodeMetadata blocks not cached are read in runs of
+        neighbouring blocks, past the block cache.
+        """
+        generation = self._statgen
+        stats = {}
+        with self._statlock:
+            for _, entry in entries:
+                if (st := self._stats.get(entry.nm)) is not None:
+                    self._stats.move_to_end(entry.nm)
+                    stats[entry.nm] = st
+        fresh = {entry.nm for _, entry in entries} - stats.keys()
+        missing = sorted(fresh)
+        unsized = set()  # Plain files recording no size, see below
+        bs = self._blockio.bs
+        x = 0
+        while x < len(missing):
+            y = x+1
+            while y < len(missing) and missing[y] == missing[y-1]+1 and y-x < READ_RUN:
+                y += 1
+            run = self._blockio.readrun(missing[x], y-x)
+            for z in range(y-x):
+                nmblk = run[z*bs:(z+1)*bs]
+                size = _intfb(nmblk[49:51]) if nmblk[48] & 1 else _intfb(nmblk[34:42])
+                stats[missing[x+z]] = (nmblk[24+18], size, _intfb(nmblk[24:26]),
+                                       _intfb(nmblk[30:34]), _intfb(nmblk[26:30]))
+                if nmblk[24+18] == 1 and size == 0 and nmblk[24+19] == 0 and not nmblk[48] & 1:
+                    unsized.add(missing[x+z])
+            x = y
+        for name, entry in entries:
+            st = stats[entry.nm]
+            if entry.nm in unsized and entry.ptr != 0:
+                # Written before sizes were kept, only an empty file has no
+                # superblock so the size is worked out from the file.
+                # Compressed files record theirs on flush, inline ones always
+                with self._fileobject(pdirnode, name, entry, self._blockio.readblock(entry.nm)) as fp:
+                    stats[entry.nm] = (1, fp.seek(0, 2)) + st[2:]
+        with self._statlock:
+            if self._statgen == generation and self._statcachesize > 0:
+                for nm in missing:
+                    self._stats[nm] = stats[nm]
+                while len(self._stats) > self._statcachesize:
+                    self._stats.popitem(last=False)
+        return [NodeStat(name, *stats[entry.nm]) for name, entry in entries]
+
+    def stat(self, path: str) -> NodeStat:
+        """
+        Returns the NodeStat of a file or directory without opening it
+        """
+        path = _normpath(path)
+        if path == "/":
+            return NodeStat("", 2, 0, 0, 0, 0)
+        pdir, name = path.rsplit("/", 1)
+        with self._lockedpath(pdir) as pdirnode:
+            entry = self._direntries(pdirnode).get(name)
+        if entry is None:
+            raise FileNotFound(f"{path} does not exist")
+        return self._nodestats(pdirnode, [(name, entry)])[0]
+
+    def scandir(self, dirname: str) -> list:
+        """
+        Lists a directory like lsdir with a NodeStat for every entry
+        """
+        with self._lockedpath(dirname) as dirnode:
+            entries = list(self._direntries(dirnode).items())
+        return self._nodestats(dirnode, entries)
 
     def rmfile(self, filename: str):
         """
-        Removes a file, if the file is not found an error is raised
+        Removes a file, if the file is not found an error is raised. Files
+        still open on it keep working, its blocks are released once the last
+        one is closed.
+        """
+        pdir, fname = filename.rsplit("/", 1)
+        with self._blockio.transaction(), self._lockedpath(pdir, write=True) as pdirnode:
+            self._removefile(pdirnode, fname, filename)
+
+    def _removefile(self, pdirnode: int, fname: str, filename: str) -> None:
+        # Must be called with the directory locked for writing
+        if (entry := self._direntries(pdirnode).get(fname)) is None:
+            raise FileNotFound("File does not exist")
+        if self._blockio.readblock(entry.nm)[24+18] != 1:
+            raise FileNotFound("Provided path exists but is not a file")
+        # The entry goes first so a crash in between only leaks blocks
+        self._removeentry(pdirnode, fname)
+        self._dentries.invalidate(_normpath(filename))
+        with self._openlock:
+            if (node := self._opennodes.get(entry.nm)) is not None:
+                # Files still open on it keep using the blocks until closed
+                node.removed = True
+                node.ptr = entry.ptr
+                return
+        self._deallocatemany(self._fileblocks(entry.ptr)+[entry.nm])
+
+    def _nodetypes(self, dirname: str) -> list:
+        # (name, node type) of every entry of a directory
+        with self._lockedpath(dirname) as dirnode:
+            entries = list(self._direntries(dirnode).items())
+        return [(name, self._blockio.readblock(entry.nm)[24+18]) for name, entry in entries]
+
+    def _exportfile(self, path: str, hostpath: str) -> None:
+        with self.open(path, 'r') as fp, open(hostpath, 'wb') as hfp:
+            shutil.copyfileobj(fp, hfp, COPY_CHUNK)
+
+    def export_tree(self, src: str, dest_dir: str, workers: int = 4) -> None:
+        """
+        Copies the directory src and everything under it into the host
+        directory dest_dir, which is created when missing. The files are
+        read by a pool of workers threads, they share the image through
+        positional reads. Entry names that could lead outside dest_dir, like
+        "..", fail with BVFSError.
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        jobs = []
+        queue = deque([(_normpath(src), dest_dir)])
+        while queue:
+            bdir, hdir = queue.popleft()
+            for name, ntype in self._nodetypes(bdir):
+                bpath = bdir.rstrip("/") + "/" + name
+                hpath = os.path.join(hdir, _hostname(bdir, name))
+                if ntype == 2:
+                    os.makedirs(hpath, exist_ok=True)
+                    queue.append((bpath, hpath))
+                else:
+                    jobs.append((bpath, hpath))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(lambda job: self._exportfile(*job), jobs):
+                pass
+
+    def import_tree(self, src_dir: str, dest: str, workers: int = 4) -> None:
+        """
+        Copies the host directory src_dir and everything under it into the
+        directory dest, which is created when missing but its parent must
+        exist. Files already there are replaced. A pool of workers threads reads the host files ahead
+        while the calling thread alone allocates blocks and updates
+        directories, files smaller than IMPORT_BATCH are created in batches
+        per directory with create_many.
+        """
+        dest = _normpath(dest)
+        if dest != "/" and not self.exists(dest):
+            self.mkdir(dest)
+        present = {dest}  # Directories that existed before the import
+        dirs = []
+        files = []  # (host path, path, size)
+        for root, dnames, fnames in os.walk(src_dir):
+            rel = os.path.relpath(root, src_dir)
+            base = dest if rel == "." else dest.rstrip("/") + "/" + rel.replace(os.sep, "/")
+            existing = dict(self._nodetypes(base)) if base in present else {}
+            for dname in dnames:
+                path = base.rstrip("/") + "/" + dname
+                if existing.get(dname) == 2:
+                    present.add(path)
+                else:
+                    dirs.append(path)
+            for fname in fnames:
+                hpath = os.path.join(root, fname)
+                if not os.path.isfile(hpath):
+                    continue
+                path = base.rstrip("/") + "/" + fname
+                if fname in existing:
+                    self.rmfile(path)
+                files.append((hpath, path, os.path.getsize(hpath)))
+        self.mkdir_many(dirs)
+
+        def readhost(hpath: str) -> bytes:
+            with open(hpath, 'rb') as hfp:
+                return hfp.read()
+
+        def readahead(pool):
+            # Yields (path, contents) of the small files in order, the reads
+            # are kept a few files ahead of the consumer
+            pending = deque()
+            for hpath, path, size in files:
+                if size < IMPORT_BATCH:
+                    pending.append((path, pool.submit(readhost, hpath)))
+                if len(pending) > 4*workers:
+                    path, fut = pending.popleft()
+                    yield path, fut.result()
+            while pending:
+                path, fut = pending.popleft()
+                yield path, fut.result()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batch = {}
+            batchsize = 0
+            for path, data in readahead(pool):
+                pdir = path.rsplit("/", 1)[0]
+                if batch and (batchsize >= IMPORT_BATCH or pdir != batchdir):
+                    self.create_many(batch)
+                    batch, batchsize = {}, 0
+                batchdir = pdir
+                batch[path] = data
+                batchsize += len(data)
+            if batch:
+                self.create_many(batch)
+
+        for hpath, path, size in files:
+            if size >= IMPORT_BATCH:
+                # Large files are streamed into blocks reserved up front
+                with open(hpath, 'rb') as hfp, self.open(path, 'w') as fp:
+                    fp.preallocate(size)
+                    shutil.copyfileobj(hfp, fp, COPY_CHUNK)
+
+    def _livelayout(self):
+        # Lists every block reachable from the root in the order compaction
+        # lays them out: a directory's blocks, then for each entry its
+        # metadata followed by the file's superblocks each with its data
+        # blocks, subdirectories come after. For every block it also lists
+        # the (index of the block, offset) of all the pointers to it, and
+        # the indexes of the first blocks of directories.
+        blocks = [0]
+        refs = [[]]
+        heads = []
+        seen = {0}
+
+        def add(blocknum: int, ref: list) -> int:
+            if blocknum in seen:
+                raise BVFSError(
+                    f"Block {blocknum} is pointed to twice, run a recovery first")
+            seen.add(blocknum)
+            blocks.append(blocknum)
+            refs.append(ref)
+            return len(blocks)-1
+
+        queue = deque([(self._rootdir, [(0, 30)])])
+        while queue:
+            dirnode, ref = queue.popleft()
+            chain = [add(dirnode, ref)]
+            heads.append(chain[0])
+            while (fp := _intfb(self._blockio.readblock(blocks[chain[-1]])[24:24+8])) != 0:
+                chain.append(add(fp, [(chain[-1], 24)]))
+            for chainidx in chain:
+                blk = self._blockio.readblock(blocks[chainidx])
+                for x in range(992//124):
+                    offset = 24+8+x*124
+                    if (nm := _intfb(blk[offset:offset+8])) == 0:
+                        continue
+                    ptr = _intfb(blk[offset+8:offset+16])
+                    add(nm, [(chainidx, offset)])
+                    ntype = self._blockio.readblock(nm)[24+18]
+                    if ntype == 2:
+                        queue.append((ptr, [(chainidx, offset+8)]))
+                        continue
+                    sbref = [(chainidx, offset+8)]
+                    prevsb = None
+                    while ptr != 0 and ntype == 1:
+                        sbidx = add(ptr, sbref)
+                        if prevsb is not None:
+                            refs[prevsb].append((sbidx, 24))  # Its previous pointer
+                        sbblk = self._blockio.readblock(ptr)
+                        for y, dptr in enumerate(struct.unpack_from(">123Q", sbblk, 24+16)):
+                            if dptr != 0:
+                                add(dptr, [(sbidx, 24+16+y*8)])
+                        sbref = [(sbidx, 24+8)]
+                        prevsb = sbidx
+                        ptr = _intfb(sbblk[24+8:24+16])
+        return blocks, refs, heads
+
+    def _moveblock(self, idx: int, dst: int, blocks: list, refs: list) -> None:
+        # The copy is written before the pointers change and the original is
+        # cleared last, a crash at any point leaves at most a lost block
+        src = blocks[idx]
+        self._blockio.writeblock(dst, bytearray(self._blockio.readblock(src)))
+        for refidx, offset in refs[idx]:
+            blk = self._blockio.readblock(blocks[refidx])
+            blk[offset:offset+8] = _inttb(dst, 8)
+            self._blockio.writeblock(blocks[refidx], blk)
+        self._blockio.writeblock(src, b'')
+        blocks[idx] = dst
+
+    def _lockdirectories(self) -> list:
+        # Takes the lock of every directory for writing, parents first like
+        # everyone else does, and returns them
+        locks = []
+        queue = deque([self._rootdir])
+        try:
+            while queue:
+                dirnode = queue.popleft()
+                lock = self._dirlock(dirnode)
+                lock.acquire(True)
+                locks.append(lock)
+                queue.extend(entry.ptr for entry in self._direntries(dirnode).values()
+                             if self._blockio.readblock(entry.nm)[24+18] == 2)
+        except BaseException:
+            for lock in locks:
+                lock.release()
+            raise
+        return locks
+
+    def compact(self, progress=None, maxmoves: int = None) -> bool:
+        """
+        Moves all live blocks to the front of the image, every directory and
+        file laid out contiguously, and cuts off the freed space. Blocks not
+        reachable from the root directory are dropped. It fails with
+        BVFSError while any file is open. Every directory is locked and, with
+        a journal, other transactions are kept out until it is done, calls
+        that were waiting for a directory that moved then fail with
+        DirectoryNotFound.
+        progress is called with the blocks done and the total now and then.
+        After maxmoves block moves it stops and returns False, running it
+        again carries on from there as every move leaves a consistent
+        filesystem. Returns True when the image is fully compacted.
+        """
+        with self._blockio.exclusive():
+            locks = self._lockdirectories()
+            try:
+                with self._openlock:
+                    if any(node.files for node in self._opennodes.values()):
+                        raise BVFSError("Can not compact while files are open")
+                return self._compact(progress, maxmoves)
+            finally:
+                for lock in locks:
+                    lock.release()
+
+    def _compact(self, progress, maxmoves: int) -> bool:
+        # Must be called with every directory locked
+        blocks, refs, heads = self._livelayout()
+        oldheads = [blocks[x] for x in heads]
+        live = set(blocks)
+        types = bytearray(self._blockio.blocktypes())
+        orphans = [x for x in range(len(types)) if types[x] != 0 and x not in live]
+        self._blockio.discard(orphans)
+        for x in orphans:
+            types[x] = 0
+        with self._alloclock:
+            self._freespace = freespace = _FreeSpace(types)
+        at = {blocknum: idx for idx, blocknum in enumerate(blocks)}
+        moves = 0
+        done = True
+        for target in range(1, len(blocks)):
+            if progress is not None and target % 1024 == 0:
+                progress(target, len(blocks))
+            if blocks[target] == target:
+                continue
+            if maxmoves is not None and moves >= maxmoves:
+                done = False
+                break
+            # A journal commits both moves or neither
+            with self._blockio.transaction():
+                if (occupant := at.pop(target, None)) is not None:
+                    # Some other block sits where this one goes, move it out of the way
+                    spill = freespace.allocate()
+                    self._moveblock(occupant, spill, blocks, refs)
+                    freespace.release(target)
+                    at[spill] = occupant
+                    moves += 1
+                if freespace.allocate() != target:
+                    raise BVFSError(
+                        f"Block {target} is not free to move a block into")
+                src = blocks[target]
+                self._moveblock(target, target, blocks, refs)
+                freespace.release(src)
+                del at[src]
+                at[target] = target
+                moves += 1
+
+        self._rootdir = blocks[1]
+        with self._dirindexlock:
+            self._dirindex.clear()
+        self._dentries.clear()
+        with self._dirlockslock:
+            # Directories that moved leave their lock, which fails anyone
+            # waiting for it, and a tombstone on their old first block
+            newheads = [blocks[x] for x in heads]
+            for old, new in zip(oldheads, newheads):
+                if old != new and (lock := self._dirlocks.pop(old, None)) is not None:
+                    lock.removed = True
+            self._deaddirs |= set(oldheads)
+            self._deaddirs -= set(newheads)
+            self._dirgen += 1
+        with self._statlock:
+            self._statgen += 1
+            self._stats.clear()
+        if done:
+            self._blockio.truncate(len(blocks))
+            with self._alloclock:
+                self._freespace = _FreeSpace(end=len(blocks))
+        else:
+            self._blockio.flush()
+        if progress is not None:
+            progress(len(blocks) if done else target, len(blocks))
+        return done
+
+    def flush(self):
+        """
+        Writes out all the blocks held back in writeback mode, with a journal
+        this commits them
+        """
+        self._blockio.flush()
+
+    def sync(self):
+        """
+        Makes every change so far durable. With a journal it is a group
+        commit, threads calling it at the same time share a single sync.
+        """
+        self._blockio.flush()
+        if self._journal is None:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def cachestats(self) -> dict:
+        """
+        Returns the block cache counters, useful for sizing the cache limit
+        """
+        return self._blockio.cachestats()
+
+    def metrics(self) -> dict:
+        """
+        Returns what the instrumentation collected so far along with the
+        block cache counters, None when the filesystem was opened without
+        metrics
         """
-        # TODO: Write this function
+        if self._metrics is None:
+            return None
+        return {**self._metrics.snapshot(), "cache": self._blockio.cachestats()}
 
     def close(self):
+        with self._openlock:
+            removed = [(nm, node.ptr) for nm, node in self._opennodes.items() if node.removed]
+            self._opennodes.clear()
+        with self._blockio.transaction():
+            for nm, ptr in removed:
+                self._deallocatemany(self._fileblocks(ptr)+[nm])
         block = self._blockio.readblock(0)
+        if self._savefreemap and (freemap := self._getfreespace().todata(len(block)-40)) is not None:
+            block[39] = 1
+            block[40:40+len(freemap)] = freemap
         block[38] = 0  # unset the locked flag
         self._blockio.writeblock(0, block)   # Write the lock back
+        self._blockio.close()
         del self._blockio
+        if self._journal is not None:
+            self._journal.close(remove=True)
         self._fp.close()
         del self._fp
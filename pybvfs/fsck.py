@@ -0,0 +1,292 @@
+from . import core, fsfix
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import argparse
+import os
+import re
+import struct
+
+CHUNK_BLOCKS = 4096  # Blocks read at a time by the scan
+SHARD_BLOCKS = 256*1024  # Least number of blocks given to a worker process
+_NODES = re.compile(rb"[\x02-\x05]")  # Type bytes of the blocks holding pointers
+_DATA = re.compile(rb"\x01")
+
+
+def _scanshard(filename: str, start: int, count: int, bs: int = core.BLOCK_SIZE) -> tuple:
+    """
+    Reads count blocks from start in chunks. Returns their type bytes, the
+    blocks holding pointers by number, NodeMetadata blocks only up to their
+    inline size, and the content size of every data block that is not full.
+    """
+    types = bytearray()
+    nodes = {}
+    partial = {}
+    with open(filename, 'rb') as fp:
+        fp.seek(start*bs)
+        for x in range(start, start+count, CHUNK_BLOCKS):
+            chunk = fp.read(min(CHUNK_BLOCKS, start+count-x)*bs)
+            # Every block's type and content size come out of a single slice each
+            ctypes = chunk[0::bs]
+            types += ctypes
+            for m in _NODES.finditer(ctypes):
+                i = m.start()
+                nodes[x+i] = chunk[i*bs:i*bs+(52 if ctypes[i] == 3 else bs)]
+            hi, lo = chunk[24::bs], chunk[25::bs]
+            for m in _DATA.finditer(ctypes):
+                i = m.start()
+                if (size := hi[i] << 8 | lo[i]) < 998:
+                    partial[x+i] = size
+    return bytes(types), nodes, partial
+
+
+def scan(filename: str, workers: int = None) -> tuple:
+    """
+    Scans the whole image, split in shards read by up to workers processes
+    at once. Small images are scanned in this process. Returns what
+    _scanshard does for the whole image.
+    """
+    blocklen = os.path.getsize(filename)//core.BLOCK_SIZE
+    workers = workers or os.cpu_count() or 1
+    shards = max(1, min(workers*4, blocklen//SHARD_BLOCKS))
+    starts = [blocklen*x//shards for x in range(shards+1)]
+    counts = [starts[x+1]-starts[x] for x in range(shards)]
+    if workers == 1 or shards == 1:
+        results = map(_scanshard, repeat(filename), starts, counts)
+        return _merge(results)
+    with ProcessPoolExecutor(workers) as pool:
+        return _merge(pool.map(_scanshard, repeat(filename), starts, counts))
+
+
+def _merge(results) -> tuple:
+    types = bytearray()
+    nodes = {}
+    partial = {}
+    for stypes, snodes, spartial in results:
+        types += stypes
+        nodes.update(snodes)
+        partial.update(spartial)
+    return bytes(types), nodes, partial
+
+
+def check(filename: str, repair: bool = False, workers: int = None) -> dict:
+    """
+    Checks the filesystem in filename, which must not be open anywhere.
+    Every block is classified by a sharded scan, then everything reachable
+    from the root directory is walked. Reports, and with repair fixes:
+    a set lock flag, a journal left behind (replayed), pointers to missing,
+    wrong or already used blocks (cleared), blocks nothing reachable points
+    to (freed), NodeMetadata sizes that do not match the content and
+    trailing free blocks (trimmed). Compressed files keep their size as the
+    content size can not be told from the blocks alone, those without a
+    valid index, left by a crash while written, are only reported.
+
+    Returns a dict of blocks, used, reachable, locked, journal (pending,
+    replayed or None), orphans, badpointers as (block, offset, pointer,
+    reason), sizes as (NodeMetadata block, recorded, actual), badindexes as
+    (NodeMetadata block, reason), trimmed and repaired.
+    """
+    report = {"journal": None, "trimmed": 0, "repaired": False}
+    jpath = filename + "-journal"
+    with open(filename, 'rb') as fp:
+        root = core._fitb(fp.read(core.BLOCK_SIZE))
+    if root[24:28] != b"BvFs":
+        raise core.MagicError(
+            f"Not a BvFs, magic header invalid: {root[24:28]}")
+    if os.path.exists(jpath) and (root[38] == core.JOURNAL_LOCK or os.path.getsize(jpath) > 0):
+        journal = core._Journal(jpath)
+        if not journal.lock():
+            journal.close()
+            raise core.LockedError("Current file system is in use by another process")
+        if repair:
+            with open(filename, 'r+b') as fp:
+                journal.replay(fp)
+            journal.close(remove=True)
+            report["journal"] = "replayed"
+        else:
+            journal.close()
+            report["journal"] = "pending"
+
+    types, nodes, partial = scan(filename, workers)
+    blocklen = len(types)
+    reach = bytearray(blocklen)
+    reach[0] = 1
+    badpointers = []
+    sizes = []
+    badindexes = []
+    patches = {}  # Block number to the (offset, bytes) written to it on repair
+
+    def bad(block: int, offset: int, ptr: int, reason: str, patch: tuple = None) -> None:
+        # The pointer is cleared on repair unless patch says otherwise
+        badpointers.append((block, offset, ptr, reason))
+        patches.setdefault(block, []).append(patch or (offset, bytes(8)))
+
+    def valid(ptr: int, btype: int) -> str:
+        # Why ptr can not be followed to a block of type btype, None if it can
+        if ptr >= blocklen or types[ptr] == 0:
+            return "missing"
+        if types[ptr] != btype:
+            return "wrong type"
+        if reach[ptr]:
+            return "used twice"
+        return None
+
+    def walkfile(block: int, offset: int, ptr: int, data: list) -> int:
+        # Marks the superblocks of a file and their data blocks reachable,
+        # block and offset locate the pointer to the first superblock.
+        # The data blocks holding the content are added to data in order.
+        # Returns the size of the content left after repair.
+        nsbs = count = last = prev = 0
+        while ptr != 0:
+            if (why := valid(ptr, 2)) is not None:
+                bad(block, offset, ptr, why)
+                break
+            reach[ptr] = 1
+            sb = nodes[ptr]
+            if (back := core._intfb(sb[24:32])) != prev:
+                bad(ptr, 24, back, "wrong previous superblock", (24, core._inttb(prev, 8)))
+            end = None  # The content ends at the first empty pointer
+            last = 0
+            for y, dptr in enumerate(struct.unpack_from(">123Q", sb, 40)):
+                if dptr != 0 and (why := valid(dptr, 1)) is not None:
+                    bad(ptr, 40+y*8, dptr, why)
+                    dptr = 0
+                if dptr == 0:
+                    end = y if end is None else end
+                    continue
+                reach[dptr] = 1
+                if end is None:
+                    last = dptr
+                    data.append(dptr)
+            count = 123 if end is None else end
+            nsbs += 1
+            block, offset, prev = ptr, 32, ptr
+            ptr = core._intfb(sb[32:40])
+        if nsbs == 0:
+            return 0
+        size = (nsbs-1)*123*998
+        if count != 0:
+            size += (count-1)*998 + partial.get(last, 998)
+        return size
+
+    root = nodes.get(0, root)  # Replaying the journal may have changed it
+    compressed = []  # (NodeMetadata block, data blocks, size, framesize) of compressed files
+    rootdir = core._intfb(root[30:38])
+    if valid(rootdir, 4) is not None:
+        raise core.BVFSError(
+            f"Root directory block {rootdir} is not a directory, the filesystem can not be recovered")
+    reach[rootdir] = 1
+    queue = [rootdir]
+    while queue:
+        chain = [queue.pop()]
+        while (fwd := core._intfb(nodes[chain[-1]][24:32])) != 0:
+            if (why := valid(fwd, 4)) is not None:
+                bad(chain[-1], 24, fwd, why)
+                break
+            reach[fwd] = 1
+            chain.append(fwd)
+        for dblock in chain:
+            blk = nodes[dblock]
+            for offset in range(32, 32+8*124, 124):
+                if (nm := core._intfb(blk[offset:offset+8])) == 0:
+                    continue
+                ptr = core._intfb(blk[offset+8:offset+16])
+                # A bad entry is emptied altogether
+                if (why := valid(nm, 3)) is not None:
+                    bad(dblock, offset, nm, why, (offset, bytes(124)))
+                    continue
+                meta = nodes[nm]
+                if meta[42] == 2:
+                    if (why := valid(ptr, 4)) is not None:
+                        bad(dblock, offset+8, ptr, why, (offset, bytes(124)))
+                        continue
+                    reach[nm] = reach[ptr] = 1
+                    queue.append(ptr)
+                    continue
+                reach[nm] = 1
+                if meta[42] != 1:
+                    continue
+                data = []
+                if meta[48] & 1:
+                    size = core._intfb(meta[49:51])
+                else:
+                    size = walkfile(dblock, offset+8, ptr, data)
+                if meta[43] != 0:
+                    compressed.append((nm, data, size, core._intfb(meta[44:48])))
+                if meta[43] == 0 and size != (recorded := core._intfb(meta[34:42])):
+                    sizes.append((nm, recorded, size))
+                    patches.setdefault(nm, []).append((34, core._inttb(size, 8)))
+
+    with open(filename, 'rb') as fp:
+        def readat(data: list, offset: int, length: int) -> bytes:
+            # Content of a file from its data blocks, 998 bytes in each
+            out = bytearray()
+            while len(out) < length:
+                x, skip = divmod(offset+len(out), 998)
+                fp.seek(data[x]*core.BLOCK_SIZE+26+skip)
+                out += fp.read(min(998-skip, length-len(out)))
+            return bytes(out)
+        for nm, data, size, framesize in compressed:
+            try:
+                core._readindex(lambda offset, length: readat(data, offset, length), size, framesize)
+            except core.BVFSError as e:
+                badindexes.append((nm, str(e)))
+
+    orphans = [x for x in range(blocklen) if types[x] != 0 and not reach[x]]
+    report.update(blocks=blocklen, used=blocklen-types.count(0), reachable=sum(reach),
+                  locked=root[38], orphans=orphans, badpointers=badpointers, sizes=sizes,
+                  badindexes=badindexes)
+    if repair:
+        if root[38] != 0 or root[39] != 0:
+            # A free map left in the root block is stale once blocks are freed
+            patches.setdefault(0, []).append((38, bytes(core.BLOCK_SIZE-38)))
+        with open(filename, 'r+b') as fp:
+            bio = core.BlockIO(fp)
+            for blocknum, changes in patches.items():
+                block = bytearray(bio.readblock(blocknum))
+                for offset, data in changes:
+                    block[offset:offset+len(data)] = data
+                bio.writeblock(blocknum, block)
+            bio.discard(orphans)
+            bio.flush()
+            fsfix.removeTruncatingBlocks(fp)
+            report["trimmed"] = blocklen - os.path.getsize(filename)//core.BLOCK_SIZE
+        report["repaired"] = True
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m pybvfs fsck",
+        description="Checks a BVFS image and optionally repairs it.")
+    parser.add_argument("image")
+    parser.add_argument("--repair", action="store_true",
+                        help="fix what is found, the image must not be open anywhere")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes scanning the image, the number of CPUs by default")
+    parser.add_argument("--verbose", action="store_true", help="list every problem found")
+    args = parser.parse_args(argv)
+
+    report = check(args.image, repair=args.repair, workers=args.workers)
+    print(f"{report['blocks']} blocks, {report['used']} used, {report['reachable']} reachable")
+    problems = unfixed = 0
+    if report["locked"]:
+        print("Lock flag set" + (", cleared" if report["repaired"] else ""))
+        problems += 1
+    if report["journal"] is not None:
+        print(f"Journal {report['journal']}")
+        problems += 1
+    for key, what in (("orphans", "unreachable blocks"), ("badpointers", "bad pointers"),
+                      ("sizes", "wrong node sizes"), ("badindexes", "compressed files without an index")):
+        if report[key]:
+            fixed = report["repaired"] and key != "badindexes"
+            print(f"{len(report[key])} {what}" + (", fixed" if fixed else ""))
+            if args.verbose:
+                for item in report[key]:
+                    print(f"  {item}")
+            problems += 1
+            unfixed += not fixed
+    if report["trimmed"]:
+        print(f"Trimmed {report['trimmed']} free blocks at the end")
+    if not problems:
+        print("Clean")
+    return 1 if unfixed or problems and not report["repaired"] else 0
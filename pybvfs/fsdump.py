@@ -1,6 +1,10 @@
 from . import core
 from functools import partial
-from io import StringIO
+import argparse
+import json
+import re
+import struct
+import sys
 
 intfb = partial(int.from_bytes, byteorder='big')
 
@@ -13,70 +17,168 @@ btype = {
     5: "Root"
 }
 
+CHUNK_BLOCKS = 4096  # Blocks read at a time
+_POINTERS = struct.Struct(">QQ123Q")  # Previous, forward and data pointers of a superblock
+_ENTRY = struct.Struct(">QQ100s8x")  # NodeMetadata pointer, superblock or directory pointer, name
+_METADATA = struct.Struct(">HIIQBBIBH")  # NodeMetadata fields up to the inline size
+
+
+def iterblocks(fp, types=None, start: int = 0, stop: int = None, bs: int = core.BLOCK_SIZE):
+    """
+    Yields (block number, block) for the blocks from start up to stop, all
+    of them by default, read straight from fp in big chunks past any cache.
+    types limits it to blocks of the given type bytes. Blocks are
+    memoryviews only valid until the next one is asked for.
+    """
+    fp.seek(0, 2)
+    blocklen = fp.tell()//bs
+    stop = blocklen if stop is None else min(stop, blocklen)
+    wanted = None
+    if types is not None:
+        wanted = re.compile(b"[" + b"".join(re.escape(bytes([t])) for t in types) + b"]")
+    fp.seek(start*bs)
+    for x in range(start, stop, CHUNK_BLOCKS):
+        chunk = memoryview(fp.read(min(CHUNK_BLOCKS, stop-x)*bs))
+        if wanted is None:
+            for i in range(len(chunk)//bs):
+                yield x+i, chunk[i*bs:(i+1)*bs]
+        else:
+            for m in wanted.finditer(chunk[0::bs].tobytes()):
+                i = m.start()
+                yield x+i, chunk[i*bs:(i+1)*bs]
+
+
+def decode(blocknum: int, blk, bs: int = core.BLOCK_SIZE) -> dict:
+    """
+    Decodes a block into a dict of its fields, named like in the
+    specification
+    """
+    info = {"block": blocknum, "offset": blocknum*bs, "type": btype.get(blk[0], "Unknown")}
+    if blk[0] == 1:
+        info.update(contentsize=intfb(blk[24:26]), null=blk[26:] == bytes(len(blk)-26))
+    elif blk[0] == 2:
+        prev, fwd, *ptrs = _POINTERS.unpack_from(blk, 24)
+        while ptrs and ptrs[-1] == 0:
+            ptrs.pop()
+        info.update(previous=prev, forward=fwd, pointers=ptrs)
+    elif blk[0] == 3:
+        perms, gid, uid, size, ntype, compression, framesize, flags, inlinesize = \
+            _METADATA.unpack_from(blk, 24)
+        info.update(perms=perms, gid=gid, uid=uid, size=size, nodetype=ntype,
+                    compression=compression, framesize=framesize,
+                    inline=bool(flags & 1), inlinesize=inlinesize)
+    elif blk[0] == 4:
+        info.update(forward=intfb(blk[24:32]), entries=[
+            {"name": name.split(b'\0', 1)[0].decode('utf-8', 'replace'), "nodemetadata": nm, "pointer": ptr}
+            for nm, ptr, name in _ENTRY.iter_unpack(blk[32:32+8*_ENTRY.size]) if nm != 0])
+    elif blk[0] == 5:
+        info.update(magic=bytes(blk[24:28]).decode('ascii', 'replace'), version=intfb(blk[28:30]),
+                    rootdir=intfb(blk[30:38]), locked=blk[38], freemap=blk[39] != 0)
+    elif blk[0] == 0:
+        info.update(empty=blk == bytes(len(blk)))
+    return info
+
+
+def describe(blocknum: int, blk, bs: int = core.BLOCK_SIZE) -> str:
+    """
+    Returns the text describing a block, the way the detailed view of
+    dumpsystem shows it
+    """
+    lines = [f"{blocknum} {hex(bs*blocknum)}: {btype.get(blk[0], 'Unknown')}"]
+    if blk[0] == 0:
+        if blk == bytes(len(blk)):
+            lines.append("\tEmpty Block")
+        else:
+            lines.append(f"\tData in Block: {sum(blk)}")
+
+    elif blk[0] == 1:
+        lines.append(f"\tContent Size: {intfb(blk[24:24+2])}")
+        lines.append(f"\tData isNull?: {blk[26:] == bytes(len(blk)-26)}")
+
+    elif blk[0] == 2:
+        prev, fwd, *ptrs = _POINTERS.unpack_from(blk, 24)
+        lines.append(f"\tPrevious SuperBlock: {prev}")
+        lines.append(f"\tForward SuperBlock: {fwd}")
+        lines.append("\tSuperblock Pointers:")
+        lines.append("")
+        lines += ["\t\t- " + " ".join(map(str, ptrs[x:x+10])) for x in range(0, len(ptrs), 10)]
+
+    elif blk[0] == 3:
+        lines.append("\tPermissions:")
+        perms = intfb(blk[24:24+2])
+        for name, shift in (("Everyone", 0), ("Group", 3), ("Owner", 6)):
+            bits = (perms >> shift) & 0b111
+            lines.append(f"\t\t{name}: {'r' if bits&0b100 else '-'}{'w' if bits&0b10 else '-'}{'x' if bits&0b1 else '-'}")
+        lines.append(f"\tNode Size: {intfb(blk[24+10:24+18])} bytes")
+        nt = blk[24+18]
+        lines.append(f"\tNode Type: {'unknown' if nt not in [1, 2] else ('directory' if nt == 2 else 'file')}")
+
+    elif blk[0] == 4:
+        lines.append(f"\tForward Pointer: {intfb(blk[24:24+8])}")
+        lines.append("\tEntries:")
+        for nm, ptr, name in _ENTRY.iter_unpack(blk[32:32+8*_ENTRY.size]):
+            if nm == 0:
+                continue
+            lines.append(f"\t\tNode Name: {name.split(bytes([0]), 1)[0]}")
+            lines.append(f"\t\t\t- NodeMetadata Pointer: {nm}")
+            lines.append(f"\t\t\t- SuperBlock/Dir Pointer: {ptr}")
+
+    elif blk[0] == 5:
+        lines.append(f"\tConstant Identifier: {bytes(blk[24:24+4])}")
+        lines.append(f"\tVersion: {intfb(blk[24+4:24+6])}")
+        lines.append(f"\tRoot Directory: {intfb(blk[24+6:24+14])}")
+        lines.append(f"\tLocked: {blk[24+14] != 0}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(fp, out, jsonlines: bool = False, short: bool = False, types=None, start: int = 0, stop: int = None) -> None:
+    """
+    Writes the blocks of fp to the text file out as they are read. Every
+    block is a line of JSON with jsonlines, otherwise described like the
+    detailed view of dumpsystem or with short only its number and type.
+    types, start and stop filter the blocks like in iterblocks.
+    """
+    for blocknum, blk in iterblocks(fp, types, start, stop):
+        if jsonlines:
+            out.write(json.dumps(decode(blocknum, blk)) + "\n")
+        elif short:
+            out.write(f"{blocknum} {hex(len(blk)*blocknum)}: {btype.get(blk[0], 'Unknown')}\n")
+        else:
+            out.write(describe(blocknum, blk))
+
+
 def dumpsystem(fp) -> str:
-    ofp = StringIO()
-    tprint = partial(print, file=ofp)
-    bio = core.BlockIO(fp)
-
-    tprint("Short View:")
-    for x in range(bio.blocklen):
-        blk = bio.readblock(x)
-        tprint(f"{x} {hex(bio.bs*x)}: {btype[blk[0]]}")
-
-    tprint("Detailed View:")
-    for x in range(bio.blocklen):
-        blk = bio.readblock(x)
-        tprint(f"{x} {hex(bio.bs*x)}: {btype[blk[0]]}")
-        if blk[0] == 0:
-            if sum(blk) == 0:
-                tprint("\tEmpty Block")
-            else:
-                tprint(f"\tData in Block: {sum(blk)}")
-        
-        elif blk[0] == 1:
-            tprint(f"\tContent Size: {intfb(blk[24:24+2])}")
-            tprint(f"\tData isNull?: {sum(blk[24+2:]) == 0}")
-        
-        elif blk[0] == 2:
-            tprint(f"\tPrevious SuperBlock: {intfb(blk[24:24+8])}")
-            tprint(f"\tForward SuperBlock: {intfb(blk[24+8:24+16])}")
-            tprint("\tSuperblock Pointers:")
-            for x in range(984//8):
-                if x % 10 == 0:
-                    tprint(f"\n\t\t- {intfb(blk[24+16+x*8: 24+16+x*8+8])}", end='')
-                else:
-                    tprint(f" {intfb(blk[24+16+x*8: 24+16+x*8+8])}", end='')
-            tprint()
-        
-        elif blk[0] == 3:
-            tprint("\tPermissions:")
-            perms = intfb(blk[24:24+2])
-            anyone = perms & 0b111
-            group = (perms >> 3) & 0b111
-            owner = (perms >> 6) & 0b111
-            tprint(f"\t\tEveryone: {'r' if anyone&0b100 else '-'}{'w' if anyone&0b10 else '-'}{'x' if anyone&0b1 else '-'}")
-            tprint(f"\t\tGroup: {'r' if group&0b100 else '-'}{'w' if group&0b10 else '-'}{'x' if group&0b1 else '-'}")
-            tprint(f"\t\tOwner: {'r' if owner&0b100 else '-'}{'w' if owner&0b10 else '-'}{'x' if owner&0b1 else '-'}")
-
-            tprint(f"\tNode Size: {intfb(blk[24+10:24+18])} bytes")
-            nt = blk[24+18]
-            tprint(f"\tNode Type: {'unknown' if nt not in [1, 2] else ('directory' if nt == 2 else 'file')}")
-
-        elif blk[0] == 4:
-            tprint(f"\tForward Pointer: {intfb(blk[24:24+8])}")
-            tprint("\tEntries:")
-            for x in range(992//124):
-                entry = blk[24+8+x*124:24+8+x*124+124]
-                if (intfb(entry[0:8]) == 0):
-                    continue
-                tprint(f"\t\tNode Name: {entry[16:16+100].split(bytes([0]), 1)[0]}")
-                tprint(f"\t\t\t- NodeMetadata Pointer: {intfb(entry[0:8])}")
-                tprint(f"\t\t\t- SuperBlock/Dir Pointer: {intfb(entry[8:16])}")
-        elif blk[0] == 5:
-            tprint(f"\tConstant Identifier: {blk[24:24+4]}")
-            tprint(f"\tVersion: {intfb(blk[24+4:24+6])}")
-            tprint(f"\tRoot Directory: {intfb(blk[24+6:24+14])}")
-            tprint(f"\tLocked: {blk[24+14] != 0}")
-    ofp.seek(0)
+    """
+    Returns the short view followed by the detailed view of every block.
+    Everything is kept in memory, use dump for big images.
+    """
+    parts = ["Short View:\n"]
+    parts += [f"{x} {hex(len(blk)*x)}: {btype.get(blk[0], 'Unknown')}\n" for x, blk in iterblocks(fp)]
+    parts.append("Detailed View:\n")
+    parts += [describe(x, blk) for x, blk in iterblocks(fp)]
     fp.seek(0)
-    return ofp.read()
+    return "".join(parts)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m pybvfs fsdump",
+        description="Prints the blocks of a BVFS image as they are read.")
+    parser.add_argument("image")
+    parser.add_argument("--json", action="store_true", help="print a line of JSON per block")
+    parser.add_argument("--short", action="store_true", help="print only the number and type of blocks")
+    parser.add_argument("--type", action="append", choices=[name.lower() for name in btype.values()],
+                        help="only print blocks of this type, can be given more than once")
+    parser.add_argument("--start", type=int, default=0, help="first block to print")
+    parser.add_argument("--stop", type=int, default=None, help="block to stop before")
+    args = parser.parse_args(argv)
+
+    types = None
+    if args.type:
+        types = [num for num, name in btype.items() if name.lower() in args.type]
+    with open(args.image, 'rb') as fp:
+        try:
+            dump(fp, sys.stdout, args.json, args.short, types, args.start, args.stop)
+        except BrokenPipeError:
+            sys.stderr.close()  # Output piped into head and the like
+    return 0
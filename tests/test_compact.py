@@ -0,0 +1,92 @@
+import os
+import random
+
+import pytest
+
+from pybvfs import core, fsck
+
+
+def fragmented(image, **kwargs):
+    # Builds an image with holes everywhere, returns the open filesystem and
+    # what every file holds
+    core.createFs(image)
+    fs = core.BVFS(image, **kwargs)
+    rng = random.Random(0)
+    contents = {}
+    for d in range(6):
+        fs.mkdir(f"/d{d}")
+        fs.mkdir(f"/gone{d}")
+        fs.mkdir(f"/d{d}/sub")
+        for f in range(12):
+            path = f"/d{d}/{'sub/' if f % 3 == 0 else ''}f{f}"
+            contents[path] = rng.randbytes(rng.choice([0, 50, 998, 3000, 130000]))
+            with fs.open(path, 'w') as fp:
+                fp.write(contents[path])
+    with fs.open("/packed", 'w', compression="zlib") as fp:
+        fp.write(b"compressible "*20000)
+    contents["/packed"] = b"compressible "*20000
+    for path in sorted(contents)[::3]:
+        fs.rmfile(path)
+        del contents[path]
+    for d in range(6):
+        fs.rmdir(f"/gone{d}")
+    return fs, contents
+
+
+def check(fs, contents):
+    for path, data in contents.items():
+        with fs.open(path, 'r') as fp:
+            assert fp.read() == data, path
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"journal": True}])
+def test_full_compaction(tmp_path, kwargs):
+    image = str(tmp_path / "c.bvfs")
+    fs, contents = fragmented(image, **kwargs)
+    fs.flush()
+    before = os.path.getsize(image)
+    assert fs.compact()
+    check(fs, contents)
+    fs.mkdir("/after")
+    fs.close()
+    assert os.path.getsize(image) < before
+    report = fsck.check(image)
+    assert report["orphans"] == [] and report["badpointers"] == [] and report["sizes"] == []
+    assert report["used"] == report["blocks"]
+
+    fs = core.BVFS(image, **kwargs)
+    check(fs, contents)
+    assert fs.lsdir("/after") == []
+    fs.close()
+
+
+def test_resumed_compaction(tmp_path):
+    image = str(tmp_path / "c.bvfs")
+    fs, contents = fragmented(image)
+    runs = 0
+    while not fs.compact(maxmoves=100):
+        runs += 1
+        check(fs, contents)
+        if runs % 2 == 0:
+            fs.close()
+            assert fsck.check(image)["badpointers"] == []
+            fs = core.BVFS(image)
+    assert runs > 1
+    check(fs, contents)
+    fs.close()
+    report = fsck.check(image)
+    assert report["orphans"] == [] and report["badpointers"] == [] and report["used"] == report["blocks"]
+
+
+def test_compaction_refused_while_files_are_open(tmp_path):
+    image = str(tmp_path / "c.bvfs")
+    fs, contents = fragmented(image)
+    path = next(iter(contents))
+    fp = fs.open(path, 'r')
+    with pytest.raises(core.BVFSError):
+        fs.compact()
+    assert fp.read() == contents[path]
+    fp.close()
+    assert fs.compact()
+    check(fs, contents)
+    fs.close()
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from pybvfs import core, fsck
+
+
+@pytest.fixture
+def image(tmp_path):
+    image = str(tmp_path / "f.bvfs")
+    core.createFs(image)
+    return image
+
+
+@pytest.mark.parametrize("size", [100, 3000])
+def test_removed_file_keeps_its_blocks_while_open(image, size):
+    fs = core.BVFS(image)
+    old = fs.open("/a", 'w')
+    old.write(b"a"*size)
+    fs.rmfile("/a")
+    with fs.open("/b", 'w') as fp:
+        fp.write(b"b"*5000)
+    old.write(b"c"*3000)
+    old.seek(0)
+    assert old.read() == b"a"*size + b"c"*3000
+    assert fs.open("/b", 'r').read() == b"b"*5000
+    assert not fs.exists("/a")
+    old.close()
+    assert fs.open("/b", 'r').read() == b"b"*5000
+    fs.close()
+    report = fsck.check(image)
+    assert report["orphans"] == [] and report["badpointers"] == [] and report["sizes"] == []
+
+
+def test_overwritten_file_released_on_close(image):
+    fs = core.BVFS(image)
+    with fs.open("/a", 'w') as fp:
+        fp.write(b"a"*5000)
+    reader = fs.open("/a", 'r')
+    with fs.open("/a", 'w') as fp:
+        fp.write(b"n"*5000)
+    assert reader.read() == b"a"*5000
+    reader.close()
+    assert fs.open("/a", 'r').read() == b"n"*5000
+    fs.close()
+    report = fsck.check(image)
+    assert report["orphans"] == [] and report["badpointers"] == []
+
+
+def test_removed_file_left_open_released_on_close_of_filesystem(image):
+    fs = core.BVFS(image)
+    fp = fs.open("/a", 'w')
+    fp.write(b"a"*5000)
+    fs.rmfile("/a")
+    fs.close()
+    assert fsck.check(image)["orphans"] == []
+
+
+@pytest.mark.parametrize("name", ["..", "."])
+def test_export_refuses_names_leaving_the_destination(image, tmp_path, name):
+    fs = core.BVFS(image)
+    fs.mkdir("/x")
+    fs.mkdir("/x/" + name)
+    fs.create_many({f"/x/{name}/pwn": b"owned"})
+    with pytest.raises(core.BVFSError):
+        fs.export_tree("/x", str(tmp_path / "out" / "inner"))
+    fs.close()
+    assert not (tmp_path / "out" / "pwn").exists()
+
+
+def test_removed_file_written_after_its_directory_is_gone(image):
+    fs = core.BVFS(image)
+    fs.mkdir("/d")
+    fp = fs.open("/d/a", 'w')
+    fs.rmfile("/d/a")
+    fs.rmdir("/d")
+    fp.write(b"x"*5000)
+    fp.close()
+    fs.close()
+    assert fsck.check(image)["orphans"] == []
+
+
+def test_stat_of_compressed_file_being_written(image):
+    fs = core.BVFS(image)
+    fp = fs.open("/z", 'w', compression="zlib")
+    fp.write(bytes(range(256))*800)
+    assert fs.stat("/z").size == 0
+    assert [st.size for st in fs.scandir("/")] == [0]
+    fp.close()
+    assert fs.stat("/z").size == 256*800
+    fs.close()
+
+
+def test_compressed_file_without_index(image):
+    fs = core.BVFS(image)
+    fp = fs.open("/z", 'w', compression="zlib")
+    fp.write(os.urandom(3*core.FRAME_SIZE))
+    # Frames stored but the index never written, as after a crash
+    fp.raw.close()
+    with pytest.raises(core.BVFSError, match="index"):
+        fs.open("/z", 'r')
+    with fs.open("/ok", 'w', compression="zlib") as other:
+        other.write(b"ok"*core.FRAME_SIZE)
+    fs.close()
+    report = fsck.check(image)
+    assert len(report["badindexes"]) == 1 and report["orphans"] == []
+
+
+def test_missing_paths_cached_within_bounds(image):
+    fs = core.BVFS(image, pathcachesize=8)
+    for x in range(100):
+        with pytest.raises(core.BVFSError):
+            fs.lsdir(f"/gone{x}/sub")
+    cache = fs._dentries
+    assert len(cache.entries) <= 8
+    assert sum(map(len, cache.negatives.values())) == len(cache.negatives) <= 8
+    fs.close()
+
+
+def test_directory_index_bounded(image):
+    fs = core.BVFS(image, dircachesize=4)
+    for x in range(20):
+        fs.mkdir(f"/d{x}")
+        with fs.open(f"/d{x}/f", 'w') as fp:
+            fp.write(b"x"*x)
+    assert len(fs._dirindex) <= 4
+    for x in range(20):
+        assert fs.lsdir(f"/d{x}") == ["f"] and fs.stat(f"/d{x}/f").size == x
+    assert len(fs._dirindex) <= 4
+    fs.close()
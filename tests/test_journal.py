@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from pybvfs import core
+
+
+@pytest.fixture
+def durable(tmp_path, monkeypatch):
+    # Keeps the content of the image as of its last fsync, what a power
+    # loss would leave behind
+    image = str(tmp_path / "j.bvfs")
+    core.createFs(image)
+    state = {"image": open(image, 'rb').read()}
+    fsync = os.fsync
+
+    def recordingfsync(fd):
+        fsync(fd)
+        if os.path.samestat(os.fstat(fd), os.stat(image)):
+            state["image"] = open(image, 'rb').read()
+    monkeypatch.setattr(os, "fsync", recordingfsync)
+    return image, state
+
+
+def powerloss(fs, image, state):
+    # Drops the filesystem without closing it and rolls the image back
+    fs._journal.file.close()
+    fs._fp.close()
+    with open(image, 'wb') as fp:
+        fp.write(state["image"])
+
+
+def test_synced_changes_survive_power_loss(durable):
+    image, state = durable
+    fs = core.BVFS(image, journal=True)
+    fs.mkdir("/important")
+    with fs.open("/important/data", 'w') as fp:
+        fp.write(b"x"*5000)
+    fs.sync()
+    powerloss(fs, image, state)
+
+    fs = core.BVFS(image, journal=True)
+    assert fs.exists("/important")
+    assert fs.open("/important/data", 'r').read() == b"x"*5000
+    fs.close()
+    assert not os.path.exists(image + "-journal")
+
+
+def test_journal_replayed_when_lock_flag_is_lost(durable):
+    image, state = durable
+    pristine = state["image"]
+    fs = core.BVFS(image, journal=True)
+    fs.mkdir("/important")
+    fs.sync()
+    state["image"] = pristine  # Not even the lock flag made it to the disk
+    powerloss(fs, image, state)
+
+    fs = core.BVFS(image)
+    assert fs.exists("/important")
+    fs.close()
+    assert not os.path.exists(image + "-journal")
+
+
+def test_journal_directory_synced_before_the_lock_flag(tmp_path, monkeypatch):
+    image = str(tmp_path / "j.bvfs")
+    core.createFs(image)
+    events = []
+    fsync, syncdir = os.fsync, core._syncdir
+
+    def recordingfsync(fd):
+        fsync(fd)
+        if os.path.samestat(os.fstat(fd), os.stat(image)):
+            events.append("image")
+
+    def recordingsyncdir(path):
+        syncdir(path)
+        events.append("dir")
+    monkeypatch.setattr(os, "fsync", recordingfsync)
+    monkeypatch.setattr(core, "_syncdir", recordingsyncdir)
+    fs = core.BVFS(image, journal=True)
+    assert events[:2] == ["dir", "image"]
+    fs.close()
@@ -0,0 +1,118 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from pybvfs import core, fsck
+
+
+def test_rmdir_and_mkdir_reusing_its_blocks(tmp_path):
+    image = str(tmp_path / "t.bvfs")
+    core.createFs(image)
+    fs = core.BVFS(image)
+    for x in range(4):
+        fs.mkdir(f"/p{x}")
+    errors = []
+
+    def churn(x):
+        try:
+            for _ in range(1000):
+                fs.mkdir(f"/p{x}/d")
+                fs.rmdir(f"/p{x}/d")
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=churn, args=(x,)) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert all(fs.lsdir(f"/p{x}") == [] for x in range(4))
+    fs.close()
+
+
+def test_directory_removed_after_it_was_resolved(tmp_path, monkeypatch):
+    image = str(tmp_path / "t.bvfs")
+    core.createFs(image)
+    fs = core.BVFS(image)
+    fs.mkdir("/p")
+    fs.mkdir("/p/d")
+    stale = fs._opendirectory("/p/d")
+    fs.rmdir("/p/d")
+    with fs.open("/victim", 'w') as fp:
+        fp.write(b"v"*5000)
+    assert stale in fs._fileblocks(fs._direntries(fs._rootdir)["victim"].ptr)
+
+    # Another thread resolved /p/d before it was removed
+    resolve = fs._opendirectory
+    monkeypatch.setattr(fs, "_opendirectory", lambda path: stale if path == "/p/d" else resolve(path))
+    with pytest.raises(core.DirectoryNotFound):
+        fs.open("/p/d/f", 'w')
+    with pytest.raises(core.DirectoryNotFound):
+        fs.lsdir("/p/d")
+    monkeypatch.undo()
+    assert fs.open("/victim", 'r').read() == b"v"*5000
+    fs.close()
+    report = fsck.check(image)
+    assert report["orphans"] == [] and report["badpointers"] == []
+
+
+def test_directory_replaced_while_resolving(tmp_path, monkeypatch):
+    image = str(tmp_path / "t.bvfs")
+    core.createFs(image)
+    fs = core.BVFS(image)
+    fs.mkdir("/p")
+    fs.mkdir("/p/d")
+    fs.mkdir("/q")
+    resolve = fs._opendirectory
+
+    def interleaved(path):
+        # Another thread removes /p/d and makes /q/e in its first block
+        # right after this one resolved it
+        dirnode = resolve(path)
+        if path == "/p/d":
+            monkeypatch.setattr(fs, "_opendirectory", resolve)
+            fs.rmdir("/p/d")
+            fs.mkdir("/q/e")
+            assert resolve("/q/e") == dirnode
+        return dirnode
+    monkeypatch.setattr(fs, "_opendirectory", interleaved)
+    with pytest.raises(core.DirectoryNotFound):
+        fs.create_many({"/p/d/f": b"x"})
+    assert fs.lsdir("/q/e") == []
+    fs.close()
+
+
+def test_concurrent_misses_share_one_read(tmp_path):
+    image = str(tmp_path / "t.bvfs")
+    core.createFs(image)
+    with open(image, 'r+b') as fp:
+        bio = core.BlockIO(fp)
+        readat, release, reads = bio._readat, threading.Event(), []
+
+        def slowreadat(offset, size):
+            reads.append(offset)
+            release.wait()
+            return readat(offset, size)
+
+        bio._readat = slowreadat
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(bio.readblock(1))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        while not reads:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+        assert reads == [core.BLOCK_SIZE] and len(results) == 8
+        assert all(data is results[0] for data in results)
+        assert bio.inflight == {}